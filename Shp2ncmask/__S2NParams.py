@@ -24,12 +24,21 @@
 
 import os
 import logging
+import importlib.util
 import pyproj
+import netCDF4
 
 ## Init logging
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
+###############
+## Variables ##
+###############
+
+## Name of the blosc compressors in numcodecs
+blosc_cnames = { "blosc_lz" : "blosclz" , "blosc_lz4" : "lz4" , "blosc_lz4hc" : "lz4hc" , "blosc_zlib" : "zlib" , "blosc_zstd" : "zstd" }
+
 #############
 ## Classes ##
 #############
@@ -50,16 +59,37 @@ class S2NParams:
 		self.list_columns      = False
 		self.describe_column   = None
 		self.select            = None
+		self.split_by          = None
 		self.log               = None
 		self.input             = None
 		self.output            = None
+		self.output_format     = "auto"
+		self.weights           = None
+		self.weights_value     = "fraction"
 		self.grid              = None
 		self.grid_mapping_name = None
 		self.method            = "point"
 		self.threshold         = 0.8
+		self.dtype             = "auto"
+		self.coords_dtype      = "auto"
+		self.chunks            = None
+		self.compression       = "zlib"
+		self.complevel         = 5
+		self.shuffle           = False
+		self.engine            = "auto"
+		self.quadtree          = None
+		self.subdivide         = None
+		self.simplify          = None
+		self.tile_size         = None
+		self.workers           = 1
 		self.iepsg             = "4326"
 		self.oepsg             = "4326"
 		self.point_per_edge    = 100
+		self.max_edge_error    = None
+		self.cache_dir         = None
+		self.cache_size        = 1024
+		self.mask_cache_dir    = None
+		self.mask_cache_size   = 1024
 		self.figure            = None
 		self.fepsg             = "4326"
 	##}}}
@@ -88,6 +118,59 @@ class S2NParams:
 			if not self.method in ["point","weight","threshold","interior","exterior"]:
 				raise Exception( f"Error: unknow method '{self.method}'" )
 			
+			## Check the storage types
+			if not self.dtype in ["auto","uint8","uint16","float32","float64"]:
+				raise Exception( f"Error: unknow dtype '{self.dtype}'" )
+			if not self.coords_dtype in ["auto","float32","float64"]:
+				raise Exception( f"Error: unknow coords dtype '{self.coords_dtype}'" )
+			
+			## Check the chunks and the compression
+			if self.chunks is not None:
+				c = [int(x) for x in self.chunks.split(",")]
+				if not len(c) == 2 or not min(c) > 0:
+					raise Exception( f"Error: chunks '{self.chunks}' are not valid" )
+				self.chunks = c
+			compressions = { "none" : True , "zlib" : True , "szip" : netCDF4.__has_szip_support__ , "zstd" : netCDF4.__has_zstandard_support__ , "bzip2" : netCDF4.__has_bzip2_support__ }
+			for c in ["blosc_lz","blosc_lz4","blosc_lz4hc","blosc_zlib","blosc_zstd"]:
+				compressions[c] = netCDF4.__has_blosc_support__
+			if not self.compression in compressions:
+				raise Exception( f"Error: unknow compression '{self.compression}'" )
+			if not self.complevel in range(10):
+				raise Exception( f"Error: the compression level must be between 0 and 9 (current: {self.complevel})" )
+			
+			## Check the engine
+			if not self.engine in ["auto","clip","intersect"]:
+				raise Exception( f"Error: unknow engine '{self.engine}'" )
+			if self.engine == "clip" and not self.iepsg == self.oepsg:
+				raise Exception( "Error: the engine 'clip' requires the same input and output epsg" )
+			
+			if self.quadtree is not None and not self.quadtree > 0:
+				raise Exception( f"Error: the block size of the quadtree must be positive (current: {self.quadtree})" )
+			
+			if self.subdivide is not None and not self.subdivide > 4:
+				raise Exception( f"Error: the maximal number of vertices of the subdivision must be greater than 4 (current: {self.subdivide})" )
+			
+			if self.simplify is not None and not self.simplify > 0:
+				raise Exception( f"Error: the simplification factor must be positive (current: {self.simplify})" )
+			
+			## Check the tiles
+			if self.tile_size is not None and not self.tile_size > 0:
+				raise Exception( f"Error: the tile size must be positive (current: {self.tile_size})" )
+			if not self.workers > 0:
+				raise Exception( f"Error: the number of workers must be positive (current: {self.workers})" )
+			
+			## Check the densification of edges
+			if self.point_per_edge < 2:
+				raise Exception( f"Error: point per edge must be at least 2 (current: {self.point_per_edge})" )
+			if self.max_edge_error is not None and not self.max_edge_error > 0:
+				raise Exception( f"Error: max edge error must be positive (current: {self.max_edge_error})" )
+			
+			## Check the cache
+			if not self.cache_size > 0:
+				raise Exception( f"Error: the size of the cache must be positive (current: {self.cache_size})" )
+			if not self.mask_cache_size > 0:
+				raise Exception( f"Error: the size of the mask cache must be positive (current: {self.mask_cache_size})" )
+			
 			## Check input file
 			if not os.path.isfile(self.input):
 				raise FileNotFoundError(f"Input file not found: {self.input}")
@@ -113,6 +196,42 @@ class S2NParams:
 				if not os.path.isdir(path):
 					raise FileNotFoundError(f"Invalid output file: {self.output}")
 				
+				## Output format
+				if self.output_format == "auto":
+					self.output_format = "zarr" if self.output.rstrip(os.path.sep).endswith(".zarr") else "netcdf"
+				if not self.output_format in ["netcdf","zarr"]:
+					raise Exception( f"Error: unknow output format '{self.output_format}'" )
+				if self.output_format == "netcdf" and not compressions[self.compression]:
+					raise Exception( f"Error: the compression '{self.compression}' is not supported by the netCDF4 library" )
+				if self.output_format == "zarr":
+					if importlib.util.find_spec("zarr") is None or importlib.util.find_spec("numcodecs") is None:
+						raise Exception( "Error: the packages 'zarr' (>=3) and 'numcodecs' are required for the zarr output" )
+					import zarr
+					if int(zarr.__version__.split(".")[0]) < 3:
+						raise Exception( f"Error: the zarr output requires zarr >= 3 (current: {zarr.__version__})" )
+					if self.compression == "szip":
+						raise Exception( "Error: the compression 'szip' is not available for the zarr output" )
+					
+					## The zarr output is compressed by numcodecs (see zarr_compressor)
+					import numcodecs
+					codec = { "zlib" : "zlib" , "zstd" : "zstd" , "bzip2" : "bz2" }.get( self.compression , "blosc" if self.compression.startswith("blosc") else None )
+					if codec is not None and not codec in numcodecs.registry.codec_registry:
+						raise Exception( f"Error: the compression '{self.compression}' is not supported by the numcodecs library" )
+					if codec == "blosc":
+						if not blosc_cnames[self.compression] in numcodecs.blosc.list_compressors():
+							raise Exception( f"Error: the compression '{self.compression}' is not supported by the numcodecs library" )
+					if self.tile_size is not None and self.chunks is not None and not ( self.tile_size % self.chunks[0] == 0 and self.tile_size % self.chunks[1] == 0 ):
+						raise Exception( f"Error: with the zarr output, the tile size ({self.tile_size}) must be a multiple of the chunks ({self.chunks[0]},{self.chunks[1]})" )
+				
+				## Weights file
+				if self.weights is not None:
+					path = os.path.sep.join( self.weights.split(os.path.sep)[:-1] )
+					if len(path) == 0: path = "."
+					if not os.path.isdir(path):
+						raise FileNotFoundError(f"Invalid weights file: {self.weights}")
+				if not self.weights_value in ["fraction","area"]:
+					raise Exception( f"Error: unknow weights value '{self.weights_value}'" )
+				
 				## Figure file
 				if self.figure is not None:
 					path = os.path.sep.join( self.figure.split(os.path.sep)[:-1] )
@@ -0,0 +1,55 @@
+
+## Copyright(c) 2023 Yoann Robin
+## 
+## This file is part of Shp2ncmask.
+## 
+## Shp2ncmask is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+## 
+## Shp2ncmask is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+## 
+## You should have received a copy of the GNU General Public License
+## along with Shp2ncmask.  If not, see <https://www.gnu.org/licenses/>.
+
+##############
+## Packages ##
+##############
+
+import logging
+import shapely
+
+from .__proj import transform_geoms
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+###############
+## Variables ##
+###############
+
+## WGS 84 / NSIDC EASE-Grid 2.0 Global, a cylindrical equal-area projection
+## (valid between 86S and 86N)
+area_epsg = "6933"
+
+
+###############
+## Functions ##
+###############
+
+def area( geoms , epsg ):##{{{
+	"""
+	Shp2ncmask.area
+	===============
+	
+	Areas (in m^2) of an array of geometries defined in epsg:epsg, computed in
+	the equal-area projection.
+	"""
+	return shapely.area( transform_geoms( geoms , epsg , area_epsg ) )
+##}}}
+
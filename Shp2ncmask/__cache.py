@@ -0,0 +1,328 @@
+
+## Copyright(c) 2023 Yoann Robin
+## 
+## This file is part of Shp2ncmask.
+## 
+## Shp2ncmask is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+## 
+## Shp2ncmask is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+## 
+## You should have received a copy of the GNU General Public License
+## along with Shp2ncmask.  If not, see <https://www.gnu.org/licenses/>.
+
+##############
+## Packages ##
+##############
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+import numpy   as np
+
+from .__release import version
+
+
+#############
+## Logging ##
+#############
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+###############
+## Variables ##
+###############
+
+## Parameters which change the output files
+mask_cache_keys = [ "select" , "split_by" , "grid" , "iepsg" , "oepsg" , "point_per_edge" , "max_edge_error" ,
+                    "method" , "threshold" , "engine" , "quadtree" , "subdivide" , "simplify" , "dtype" ,
+                    "coords_dtype" , "chunks" , "compression" , "complevel" , "shuffle" , "output_format" ,
+                    "weights_value" ]
+
+## Parameters which change only the zarr output (the tiles are the chunks)
+zarr_cache_keys = [ "tile_size" ]
+
+
+###############
+## Functions ##
+###############
+
+def disk_size( ifile ):##{{{
+	"""
+	Size (in bytes) used on disk by the file ifile. Arrays of the grid cache
+	are sparse files until all their cells are written, so the allocated size
+	is used when the file system gives it.
+	"""
+	st = os.stat(ifile)
+	if hasattr( st , "st_blocks" ):
+		return st.st_blocks * 512
+	return st.st_size
+##}}}
+
+def evict_lru( path , max_size ):##{{{
+	"""
+	Remove the least recently used entries (sub-directories) of the cache
+	path, until its size (in bytes) is lower than max_size. The last access
+	of an entry is the modification time of its directory.
+	"""
+	entries = []
+	for key in os.listdir(path):
+		entry = os.path.join( path , key )
+		if key.startswith(".") or not os.path.isdir(entry): ## Entries being written are skipped
+			continue
+		try:
+			size = sum( disk_size( os.path.join( root , f ) ) for root,_,files in os.walk(entry) for f in files )
+			entries.append( (os.path.getmtime(entry),size,entry) )
+		except OSError: ## Removed by another process
+			continue
+	
+	total = sum( e[1] for e in entries )
+	for _,size,entry in sorted(entries):
+		if total <= max_size:
+			break
+		logger.info( f" * Evict the entry {os.path.basename(entry)} from the cache" )
+		shutil.rmtree( entry , ignore_errors = True )
+		total -= size
+##}}}
+
+def copy_path( src , dst ):##{{{
+	"""
+	Copy the file or the directory (zarr store) src to dst, replacing dst.
+	"""
+	if os.path.isdir(dst):
+		shutil.rmtree(dst)
+	if os.path.isdir(src):
+		shutil.copytree( src , dst )
+	else:
+		shutil.copyfile( src , dst )
+##}}}
+
+
+#############
+## Classes ##
+#############
+
+class GridCache:
+	"""
+	Shp2ncmask.GridCache
+	====================
+	
+	Persistent cache of the arrays of the cells of grids, in the directory
+	path. Each grid has an entry (a sub-directory) identified by a hash of its
+	parameters (xparams, yparams, epsg, ppe), containing one '.npy' file per
+	array, of shape (ny,nx,...), and a '.done.npy' file flagging the cells
+	already computed. A subgrid (a tile, see Grid.subgrid) reads and writes
+	its cells in the arrays of its full grid, so all the tiles of a grid share
+	one entry, whatever the tile size. Arrays are used as memory maps, so only
+	the parts read or written are loaded.
+	
+	The total size of the cache is limited to max_size (in MB): the least
+	recently used entries are removed by evict, called once per run.
+	"""
+	
+	def __init__( self , path , max_size = 1024 ):##{{{
+		self.path     = path
+		self.max_size = max_size * 2**20
+		os.makedirs( self.path , exist_ok = True )
+	##}}}
+	
+	def key( self , grid ):##{{{
+		"""
+		Key of the entry of the full grid of grid, and parameters of this full
+		grid.
+		"""
+		root   = grid.root
+		params = { "xparams" : [float(p) for p in root.xparams] , "yparams" : [float(p) for p in root.yparams] , "epsg" : str(root.epsg) , "ppe" : int(root.ppe) }
+		key    = hashlib.sha1( json.dumps( params , sort_keys = True ).encode() ).hexdigest()
+		return key,params
+	##}}}
+	
+	def _cells( self , grid ):##{{{
+		j0,i0 = grid.offset
+		return slice(j0,j0 + grid.ny),slice(i0,i0 + grid.nx)
+	##}}}
+	
+	def _open( self , entry , name , shape , dtype ):##{{{
+		"""
+		Array name of the entry as a writable memory map, created (with zeros)
+		if needed. The file is created under a temporary name and linked, so
+		concurrent processes share the same file.
+		"""
+		ofile = os.path.join( entry , f"{name}.npy" )
+		if os.path.isfile(ofile):
+			array = np.load( ofile , mmap_mode = "r+" )
+			if array.shape == shape and array.dtype == dtype:
+				return array
+			del array
+			os.remove(ofile)
+		
+		tfile = os.path.join( entry , f".{name}.{os.getpid()}.npy" )
+		np.lib.format.open_memmap( tfile , mode = "w+" , dtype = dtype , shape = shape ).flush()
+		try:
+			os.link( tfile , ofile )
+		except FileExistsError: ## Created by another process
+			pass
+		os.remove(tfile)
+		
+		return np.load( ofile , mmap_mode = "r+" )
+	##}}}
+	
+	def load( self , grid , name ):##{{{
+		"""
+		Array name of the cells of the grid as a memory map, None if one of its
+		cells is not in the cache.
+		"""
+		key,_ = self.key(grid)
+		entry = os.path.join( self.path , key )
+		ifile = os.path.join( entry , f"{name}.npy" )
+		dfile = os.path.join( entry , f"{name}.done.npy" )
+		if not ( os.path.isfile(ifile) and os.path.isfile(dfile) ):
+			return None
+		
+		cells = self._cells(grid)
+		try:
+			if not np.all( np.load( dfile , mmap_mode = "r" )[cells] ):
+				return None
+			array = np.load( ifile , mmap_mode = "r" )[cells]
+		except (OSError,ValueError): ## Removed or being replaced by another process
+			return None
+		
+		## Access time of the entry, for the eviction
+		os.utime(entry)
+		logger.info( f" * Load '{name}' from the cache {key}" )
+		
+		return array
+	##}}}
+	
+	def save( self , grid , name , array ):##{{{
+		"""
+		Save the array name (of shape (ny,nx,...)) of the cells of the grid, in
+		the array of its full grid. The cells are flagged as done once written,
+		so concurrent processes never read partial cells.
+		"""
+		key,params = self.key(grid)
+		entry = os.path.join( self.path , key )
+		os.makedirs( entry , exist_ok = True )
+		
+		pfile = os.path.join( entry , "params.json" )
+		if not os.path.isfile(pfile):
+			with open( pfile , "w" ) as f:
+				json.dump( params , f )
+		
+		array = np.asarray(array)
+		root  = grid.root
+		cells = self._cells(grid)
+		data  = self._open( entry , name , (root.ny,root.nx) + array.shape[2:] , array.dtype )
+		done  = self._open( entry , f"{name}.done" , (root.ny,root.nx) , np.dtype("uint8") )
+		data[cells] = array
+		data.flush()
+		done[cells] = 1
+		done.flush()
+		logger.info( f" * Save '{name}' in the cache {key}" )
+	##}}}
+	
+	def evict( self ):##{{{
+		"""
+		Remove the least recently used entries until the size of the cache is
+		lower than max_size.
+		"""
+		evict_lru( self.path , self.max_size )
+	##}}}
+	
+
+class MaskCache:
+	"""
+	Shp2ncmask.MaskCache
+	====================
+	
+	Content-addressed cache of the output files, in the directory path. The
+	key of an entry is a hash of the content of the shapefile (and of its
+	.shx, .dbf, .prj and .cpg files), and of the parameters which change the
+	output (see mask_cache_keys). On a hit, the files are copied from the
+	cache, and no mask is computed. A file not written (e.g. an empty weights
+	file, see save_weights) is recorded by a marker, and removed on a hit.
+	
+	The total size of the cache is limited to max_size (in MB), the least
+	recently used entries are removed.
+	"""
+	
+	def __init__( self , path , max_size = 1024 ):##{{{
+		self.path     = path
+		self.max_size = max_size * 2**20
+		os.makedirs( self.path , exist_ok = True )
+	##}}}
+	
+	def key( self , ifile , params ):##{{{
+		"""
+		Key of the shapefile ifile with the dict of parameters params, and the
+		version of Shp2ncmask (masks of other versions are not used).
+		"""
+		h    = hashlib.sha256()
+		h.update( version.encode() )
+		stem = os.path.splitext(ifile)[0]
+		for ext in ["shp","shx","dbf","prj","cpg"]:
+			fname = f"{stem}.{ext}"
+			if not os.path.isfile(fname):
+				continue
+			h.update( ext.encode() )
+			with open( fname , "rb" ) as f:
+				for block in iter( lambda: f.read(2**20) , b"" ):
+					h.update(block)
+		h.update( json.dumps( params , sort_keys = True , default = str ).encode() )
+		return h.hexdigest()
+	##}}}
+	
+	def load( self , key , files ):##{{{
+		"""
+		Copy the files of the entry key to the paths given by the dict files
+		(name -> path). Returns False if the entry is not in the cache.
+		"""
+		entry = os.path.join( self.path , key )
+		if not all( os.path.exists( os.path.join( entry , name ) ) or os.path.isfile( os.path.join( entry , f"{name}.empty" ) ) for name in files ):
+			return False
+		os.utime(entry)
+		for name in files:
+			src = os.path.join( entry , name )
+			if os.path.exists(src):
+				copy_path( src , files[name] )
+			elif os.path.isfile(files[name]):
+				os.remove(files[name])
+		logger.info( f" * Mask loaded from the cache {key}" )
+		return True
+	##}}}
+	
+	def save( self , key , files , params ):##{{{
+		"""
+		Copy the files given by the dict files (name -> path) in the entry key,
+		and evict the least recently used entries if the cache is too large.
+		A path None is a file not written, recorded by a marker. The entry is
+		built in a temporary directory and renamed.
+		"""
+		entry = os.path.join( self.path , key )
+		tmp   = os.path.join( self.path , f".{key}.{os.getpid()}" )
+		os.makedirs( tmp , exist_ok = True )
+		for name in files:
+			if files[name] is None:
+				open( os.path.join( tmp , f"{name}.empty" ) , "w" ).close()
+			else:
+				copy_path( files[name] , os.path.join( tmp , name ) )
+		with open( os.path.join( tmp , "params.json" ) , "w" ) as f:
+			json.dump( params , f , default = str )
+		
+		shutil.rmtree( entry , ignore_errors = True )
+		os.replace( tmp , entry )
+		logger.info( f" * Mask saved in the cache {key}" )
+		
+		evict_lru( self.path , self.max_size )
+	##}}}
+	
+
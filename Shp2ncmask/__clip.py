@@ -0,0 +1,221 @@
+
+## Copyright(c) 2023 Yoann Robin
+## 
+## This file is part of Shp2ncmask.
+## 
+## Shp2ncmask is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+## 
+## Shp2ncmask is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+## 
+## You should have received a copy of the GNU General Public License
+## along with Shp2ncmask.  If not, see <https://www.gnu.org/licenses/>.
+
+##############
+## Packages ##
+##############
+
+import logging
+import numpy   as np
+import shapely
+
+from .__area import area_epsg
+from .__proj import transform_xy
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+###############
+## Functions ##
+###############
+
+def ring_edges( features ):##{{{
+	"""
+	Shp2ncmask.ring_edges
+	=====================
+	
+	Edges of all the rings of an array of (multi)polygons. Returns the arrays
+	xa, ya, xb, yb of the start / end of the edges, and an array w of +1 / -1,
+	such that w times the edge is oriented counter-clockwise for exterior rings
+	and clockwise for holes.
+	"""
+	
+	polys       = shapely.get_parts( shapely.get_parts( np.asarray(features) ) )
+	polys       = polys[shapely.get_type_id(polys) == shapely.GeometryType.POLYGON]
+	rings,ipoly = shapely.get_rings( polys , return_index = True )
+	xy,iring    = shapely.get_coordinates( rings , return_index = True )
+	
+	## Exterior rings are the first ring of each polygon
+	exterior = np.ones( rings.size , dtype = bool )
+	exterior[1:] = ipoly[1:] != ipoly[:-1]
+	
+	## Orientation from the signed area (shoelace)
+	valid = iring[1:] == iring[:-1]
+	xa,ya = xy[:-1,0][valid],xy[:-1,1][valid]
+	xb,yb = xy[1:,0][valid],xy[1:,1][valid]
+	ie    = iring[:-1][valid]
+	sarea = np.bincount( ie , weights = xa * yb - xb * ya , minlength = rings.size )
+	w     = np.where( exterior , 1. , -1. ) * np.where( sarea < 0 , -1. , 1. )
+	
+	return xa,ya,xb,yb,w[ie]
+##}}}
+
+def clip_area( xa , ya , xb , yb , w , xc , yc , yfun = None ):##{{{
+	"""
+	Shp2ncmask.clip_area
+	====================
+	
+	Area of the polygons, given by their oriented edges (see ring_edges), in each
+	cell of the rectilinear grid with increasing cell corners xc and yc. Returns
+	an array of shape (yc.size-1,xc.size-1).
+	
+	From Green's theorem, the area of the polygons in the cell [xc[i],xc[i+1]] x
+	[yc[j],yc[j+1]] is the sum over the edges of -int G_j(y(x)) dx, with x in
+	[xc[i],xc[i+1]] and G_j(y) = clip(y,yc[j],yc[j+1]) - yc[j]. Edges are split
+	along the columns, rows fully below a piece of edge are accumulated with a
+	cumulative sum, and only the rows crossed by the piece are computed
+	explicitly. The cost grows with the number of vertices and of crossings of
+	grid lines, not with the number of cells.
+	
+	If yfun (increasing) is given, the area element is dx d(yfun(y)), i.e. the
+	area is measured in the coordinates (x,yfun(y)) while the edges stay
+	straight in (x,y). Crossed rows are then integrated with a Gauss-Legendre
+	quadrature, exact if yfun is None.
+	"""
+	
+	nx = xc.size - 1
+	ny = yc.size - 1
+	Fc = yc if yfun is None else yfun(yc)
+	
+	## Vertical edges do not contribute, and we integrate along increasing x
+	keep  = ~(xa == xb)
+	xa,ya,xb,yb,w = xa[keep],ya[keep],xb[keep],yb[keep],w[keep]
+	coef  = - w * np.sign( xb - xa )
+	swap  = xb < xa
+	xl    = np.where( swap , xb , xa )
+	xr    = np.where( swap , xa , xb )
+	yl    = np.where( swap , yb , ya )
+	yr    = np.where( swap , ya , yb )
+	slope = ( yr - yl ) / ( xr - xl )
+	
+	## Keep the part of the edges inside the grid along x
+	keep  = ( xr > xc[0] ) & ( xl < xc[-1] )
+	xl,xr,yl,slope,coef = xl[keep],xr[keep],yl[keep],slope[keep],coef[keep]
+	x0    = np.maximum( xl , xc[0]  )
+	x1    = np.minimum( xr , xc[-1] )
+	
+	## Split the edges along the columns
+	i0   = np.clip( np.searchsorted( xc , x0 , side = "right" ) - 1 , 0 , nx - 1 )
+	i1   = np.clip( np.searchsorted( xc , x1 , side = "left"  ) - 1 , 0 , nx - 1 )
+	n    = i1 - i0 + 1
+	rep  = np.repeat( np.arange(n.size) , n )
+	col  = i0[rep] + np.arange(rep.size) - np.repeat( np.cumsum(n) - n , n )
+	px0  = np.maximum( x0[rep] , xc[col]   )
+	px1  = np.minimum( x1[rep] , xc[col+1] )
+	keep = px1 > px0
+	rep,col,px0,px1 = rep[keep],col[keep],px0[keep],px1[keep]
+	L    = px1 - px0
+	q0   = yl[rep] + slope[rep] * ( px0 - xl[rep] )
+	q1   = yl[rep] + slope[rep] * ( px1 - xl[rep] )
+	qlo  = np.minimum( q0 , q1 )
+	qhi  = np.maximum( q0 , q1 )
+	c    = coef[rep]
+	
+	## Rows fully below the piece of edge: cumulative sum along the rows
+	jlo  = np.clip( np.searchsorted( yc , qlo , side = "right" ) - 1 , 0 , ny )
+	D    = np.bincount( col * (ny + 1) , weights = c * L , minlength = nx * (ny + 1) ) \
+	     - np.bincount( col * (ny + 1) + jlo , weights = c * L , minlength = nx * (ny + 1) )
+	A    = np.cumsum( D.reshape(nx,ny+1)[:,:-1] , axis = 1 ).T * np.diff(Fc).reshape(-1,1)
+	
+	## Rows crossed by the piece of edge
+	jhi  = np.clip( np.searchsorted( yc , qhi , side = "left" ) - 1 , -1 , ny - 1 )
+	m    = np.maximum( jhi - jlo + 1 , 0 )
+	rep  = np.repeat( np.arange(m.size) , m )
+	row  = jlo[rep] + np.arange(rep.size) - np.repeat( np.cumsum(m) - m , m )
+	
+	gx,gw = np.polynomial.legendre.leggauss(4)
+	def J( k , j ):
+		## int max(F(y(x)) - F(yc[j]),0) dx along the piece k, written as the
+		## mean of F - F(yc[j]) over the part of [qlo,qhi] above yc[j], times
+		## the length of the piece above yc[j]; stable for flat pieces
+		lo,hi = qlo[k],qhi[k]
+		a     = np.maximum( lo , yc[j] )
+		width = np.maximum( hi - a , 0 )
+		u     = ( a + hi ) / 2 + width / 2 * gx.reshape(-1,1)
+		Fu    = u if yfun is None else yfun(u.ravel()).reshape(u.shape)
+		mean  = ( gw.reshape(-1,1) * ( Fu - Fc[j] ) ).sum(0) / 2
+		ratio = np.where( hi > lo , width / np.where( hi > lo , hi - lo , 1 ) , lo >= yc[j] )
+		return L[k] * ratio * mean
+	
+	I = c[rep] * ( J( rep , row ) - J( rep , row + 1 ) )
+	A = A + np.bincount( row * nx + col[rep] , weights = I , minlength = nx * ny ).reshape(ny,nx)
+	
+	return A
+##}}}
+
+def clip_fraction( features , grid , eps = 1e-9 , window = None ):##{{{
+	"""
+	Shp2ncmask.clip_fraction
+	========================
+	
+	Fraction of each cell of the grid covered by the features, which must be in
+	the projection of the grid. No cell polygon is built.
+	
+	For a geographic grid the area element is the one of a cylindrical
+	equal-area projection, so fractions are fractions of area as for the
+	intersection engine, while the edges of the features stay straight in the
+	projection of the shapefile. Otherwise fractions are planar in the
+	projection of the grid. Values closer than eps to 0 or 1 are set to 0 or 1.
+	
+	If window = (j0,j1,i0,i1) is given, only the cells [j0:j1,i0:i1] are
+	computed, and the output has the shape (j1-j0,i1-i0).
+	"""
+	
+	xa,ya,xb,yb,w = ring_edges(features)
+	
+	yfun = None
+	if grid.crs.is_geographic:
+		yfun = lambda y: transform_xy( np.zeros_like(y) , y , grid.epsg , area_epsg )[1]
+	
+	xc,yc = grid.xc,grid.yc
+	if window is None:
+		logger.info( f" * Clip {xa.size} edges on the grid" )
+	else:
+		j0,j1,i0,i1 = window
+		xc,yc = xc[i0:i1+1],yc[j0:j1+1]
+	A    = clip_area( xa , ya , xb , yb , w , xc , yc , yfun = yfun )
+	Fc   = yc if yfun is None else yfun(yc)
+	frac = A / ( np.diff(Fc).reshape(-1,1) * np.diff(xc).reshape(1,-1) )
+	frac = np.clip( frac , 0 , 1 )
+	frac[frac < eps]     = 0
+	frac[frac > 1 - eps] = 1
+	
+	return frac
+##}}}
+
+def clip_windows( features , grid ):##{{{
+	"""
+	Shp2ncmask.clip_windows
+	=======================
+	
+	Window (j0,j1,i0,i1) of the cells of the grid covering the bounds of each
+	feature, as four arrays. The window is empty (j1 <= j0 or i1 <= i0) if the
+	feature is outside the grid.
+	"""
+	
+	bounds = shapely.bounds( np.asarray(features) )
+	xc,yc  = grid.xc,grid.yc
+	i0 = np.clip( np.searchsorted( xc , bounds[:,0] , side = "right" ) - 1 , 0 , grid.nx )
+	i1 = np.clip( np.searchsorted( xc , bounds[:,2] , side = "left"  )     , 0 , grid.nx )
+	j0 = np.clip( np.searchsorted( yc , bounds[:,1] , side = "right" ) - 1 , 0 , grid.ny )
+	j1 = np.clip( np.searchsorted( yc , bounds[:,3] , side = "left"  )     , 0 , grid.ny )
+	
+	return j0,j1,i0,i1
+##}}}
+
@@ -0,0 +1,153 @@
+
+## Copyright(c) 2023 Yoann Robin
+## 
+## This file is part of Shp2ncmask.
+## 
+## Shp2ncmask is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+## 
+## Shp2ncmask is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+## 
+## You should have received a copy of the GNU General Public License
+## along with Shp2ncmask.  If not, see <https://www.gnu.org/licenses/>.
+
+##############
+## Packages ##
+##############
+
+import logging
+import concurrent.futures
+import numpy   as np
+import shapely
+
+from .__logs import log_start_end
+
+
+#############
+## Logging ##
+#############
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+###############
+## Functions ##
+###############
+
+def overlap_pairs( features ):##{{{
+	"""
+	Shp2ncmask.overlap_pairs
+	========================
+	
+	Pairs (i,j) of index of features whose interiors intersect (overlap, or
+	one contains the other). Features which only touch along their borders
+	are not paired.
+	"""
+	
+	features = np.asarray(features)
+	tree     = shapely.STRtree(features)
+	shapely.prepare(features)
+	
+	pairs = [ tree.query( features , predicate = p ) for p in ["overlaps","contains"] ]
+	i     = np.hstack( [ p[0] for p in pairs ] )
+	j     = np.hstack( [ p[1] for p in pairs ] )
+	keep  = ~(i == j)
+	
+	return i[keep],j[keep]
+##}}}
+
+def overlap_layers( features ):##{{{
+	"""
+	Shp2ncmask.overlap_layers
+	=========================
+	
+	Layer of each feature, such that two features of the same layer do not
+	overlap (see overlap_pairs). Layers are given greedily in the order of the
+	features, so features without overlap are all in the layer 0.
+	"""
+	
+	features = np.asarray(features)
+	layer    = np.zeros( features.size , dtype = int )
+	i,j      = overlap_pairs(features)
+	if i.size == 0:
+		return layer
+	
+	for k in np.unique( np.maximum(i,j) ):
+		used = set( layer[np.hstack( ( j[(i == k) & (j < k)] , i[(j == k) & (i < k)] ) )] )
+		layer[k] = min( set(range(len(used) + 1)) - used )
+	
+	return layer
+##}}}
+
+def overlap_groups( features ):##{{{
+	"""
+	Shp2ncmask.overlap_groups
+	=========================
+	
+	Label of the group of each feature, two overlapping features (see
+	overlap_pairs) being in the same group. The label of a group is the
+	smallest index of its features.
+	"""
+	
+	features = np.asarray(features)
+	i,j      = overlap_pairs(features)
+	
+	## Connected components, by propagation of the minimal label
+	label = np.arange(features.size)
+	while i.size > 0:
+		m   = np.minimum( label[i] , label[j] )
+		new = label.copy()
+		np.minimum.at( new , i , m )
+		np.minimum.at( new , j , m )
+		new = new[new]
+		if np.all( new == label ):
+			break
+		label = new
+	
+	return label
+##}}}
+
+@log_start_end(logger)
+def dissolve_overlaps( ish , workers = 1 ):##{{{
+	"""
+	Shp2ncmask.dissolve_overlaps
+	============================
+	
+	Merge the overlapping features of ish (see overlap_groups), so that the
+	features of the output do not overlap, and the fraction of a cell covered
+	by their union is the sum of the fractions covered by each feature. The
+	unions of the groups are computed in parallel by workers threads. A merged
+	feature keeps the index and columns of its first feature. ish is returned
+	as is if no feature overlaps.
+	"""
+	
+	if ish.shape[0] < 2:
+		return ish
+	
+	features = ish.geometry.to_numpy()
+	label    = overlap_groups(features)
+	ulabel,count = np.unique( label , return_counts = True )
+	if ulabel.size == features.size:
+		logger.info( " * No overlapping features" )
+		return ish
+	
+	groups = [ features[label == l] for l in ulabel[count > 1] ]
+	logger.info( f" * {features.size} features, {len(groups)} group(s) of overlapping features" )
+	with concurrent.futures.ThreadPoolExecutor( max_workers = workers ) as pool:
+		unions = list( pool.map( shapely.union_all , groups ) )
+	
+	merged = features[ulabel].copy()
+	merged[count > 1] = unions
+	ish = ish.iloc[ulabel].copy()
+	ish.geometry = merged
+	logger.info( f" * {ish.shape[0]} features after the dissolve" )
+	
+	return ish
+##}}}
+
@@ -41,7 +41,7 @@ Parameters
 --grid [comma separated float]
     Grid used. See the grid section.
 --output [string]
-    The output netcdf file.
+    The output netcdf file, or zarr store if it ends with '.zarr'.
 
 
 Optional parameters
@@ -55,17 +55,86 @@ Optional parameters
 --describe-column
     Describe values of a column.
 --select [string and string]
-    Select a row of a column. Must be pass as '-s COL_NAME ROW_NAME'
+    Select a row of a column. Must be pass as '-s COL_NAME ROW_NAME'. If the
+    row is not found, it is compared ignoring case, accents, spaces, '-' and
+    '_'. Only the features of the row are read.
+--split-by [string]
+    Build one mask per value of a column, in a single run. The output variable
+    'area_fraction' has then a 'region' dimension, and the variable 'region'
+    gives the value of the column for each layer. Only the regions with a
+    feature whose bounding box intersects the domain of the grid are kept, so
+    the regions depend on the grid, and a region only close to the domain has
+    a layer of zeros. It is an error if no region is kept.
 --method [string] default is 'point'.
     Method used to build the mask. See the method section.
 --threshold [float] default is 0.8
     Threshold used by the method 'threshold'.
+--dtype [string] default is 'auto'.
+    Storage type of the mask, 'uint8', 'uint16', 'float32' or 'float64'. See
+    the storage section.
+--coords-dtype [string] default is 'auto'.
+    Storage type of the 2d coordinates of a projected grid, 'float32' or
+    'float64'. See the storage section.
+--chunks [comma separated int]
+    Chunks 'cy,cx' of the 2d variables along the y / x axes. See the storage
+    section.
+--compression [string] default is 'zlib'.
+    Compression of the netcdf variables, 'none', 'zlib', 'szip', 'zstd',
+    'bzip2', 'blosc_lz', 'blosc_lz4', 'blosc_lz4hc', 'blosc_zlib' or
+    'blosc_zstd' (if supported by the netCDF4 library).
+--complevel [int] default is 5.
+    Compression level, between 0 and 9.
+--shuffle
+    Apply the shuffle filter before the compression.
+--engine [string] default is 'auto'.
+    Engine used to compute the area fractions. See the engine section.
+--quadtree [int] default is 64 if the flag is given.
+    Classify the cells by blocks of this size, refined only along the
+    boundaries. Used by the engine 'intersect'. See the engine section.
+--subdivide [int] default is 256 if the flag is given.
+    Split the polygons in pieces of at most this number of vertices before the
+    intersection. Used by the engine 'intersect' and the method 'point'. See
+    the engine section.
+--simplify [float] default is 0.1 if the flag is given.
+    Simplify the polygons with a tolerance equal to this fraction of the size
+    of the cells. See the engine section.
 --iepsg [str] default is 4326.
     epsg code of the input shapefile.
 --output-epsg [str] default is 4326.
     epsg code of the output mask.
+--tile-size [int]
+    Build the mask by tiles of this number of cells along each axis, only the
+    current tiles are in memory. See the grid section.
+--workers [int] default is 1.
+    Number of processes computing tiles in parallel, with '--tile-size', and
+    of threads merging overlapping polygons.
 --point-per-edge [int] default is 100.
     Point per edge, see grid section.
+--max-edge-error [float]
+    Maximal error (in units of the grid) allowed on the edges of the cells
+    once re-projected. If given, the point per edge is adapted, and
+    '--point-per-edge' is the maximal value. See grid section.
+--cache-dir [string]
+    Directory of a cache of the grids. See grid section.
+--cache-size [float] default is 1024.
+    Maximal size (in MB) of the cache of the grids.
+--mask-cache-dir [string]
+    Directory of a cache of the output files. If the same mask (same content
+    of the shapefile, selection, grid, method, ..., and same version of
+    Shp2ncmask) is asked again, the files are copied from the cache. Not used
+    with '--figure'.
+--mask-cache-size [float] default is 1024.
+    Maximal size (in MB) of the cache of the output files, the least recently
+    used masks are removed.
+--weights [string]
+    Netcdf file where the overlap weights between cells and features are saved
+    as a sparse matrix. See the weights section.
+--weights-value [string] default is 'fraction'.
+    Value of the weights, 'fraction' (fraction of the cell covered by the
+    feature) or 'area' (area of the overlap, in m2).
+--output-format [string] default is 'auto'.
+    Format of the output, 'netcdf' or 'zarr'. With 'auto', 'zarr' if the
+    output ends with '.zarr', 'netcdf' otherwise. See the storage section.
 --figure [string]
     File of a figure which plot the mask.
 --fepsg default is 4326.
@@ -98,12 +167,35 @@ Note 1: The first point of the x-axis is xmin, but the last point is the
 maximal value of the form 'xmin + N * dx' lower than 'xmax + dx / 2' (and the
 same for the y-axis).
 
-Note 2: To compute the area, cells are re-projected in the Mercator projection.
-Thus a cell defined by the four corners is again a cell in the Mercator
-projection, but which not represente the area of the original projection. To
-overcome this problem, a cell is not defined by only its four corners, but each
-edge of each cell is defined by '--point-per-edge' points, equally spaced
-between the corners. The default value of '--point-per-edge' is equal to 100.
+Note 2: To compute the area, cells are re-projected in an equal-area projection
+(epsg:6933, valid between 86S and 86N). Thus a cell defined by the four corners
+is again a cell in this projection, but which not represente the area of the
+original projection. To overcome this problem, a cell is not defined by only its
+four corners, but each edge of each cell is defined by '--point-per-edge'
+points, equally spaced between the corners. The default value of
+'--point-per-edge' is equal to 100.
+
+Note 3: With '--max-edge-error', the number of points per edge is the lowest
+value such that the re-projected edges deviate from the true edges by less than
+the given error. It is estimated on a sub-sample of the cells, '--point-per-edge'
+is then used as the maximal value. If the input and output epsg are the same,
+only the four corners are used.
+
+Note 4: With '--tile-size N', the grid is split in tiles of NxN cells, each tile
+is an independent grid whose mask is computed separately, possibly by several
+processes with '--workers'. Each tile is written in the output file as soon as
+it is computed, so the memory used depends on the size of the tiles, not on the
+size of the grid. The mask is the same as without tiles.
+
+Note 5: With '--cache-dir', the arrays computed for a grid (coordinates and
+bounds in lat / lon, bounding boxes of the cells in the projection of the
+shapefile) are saved in this directory, and loaded by the next runs with the
+same grid (same '--grid', '--oepsg' and point per edge) instead of being
+computed again. Arrays are stored as '.npy' files, loaded as memory maps. With
+tiles, each tile writes its cells in the arrays of the full grid, so the cache
+is shared by runs with any tile size, or without tiles. At the end of a run,
+if the cache is larger than '--cache-size', the least recently used grids are
+removed.
 
 
 Methods
@@ -128,12 +220,105 @@ Methods
     the shapefile.
 
 
+Storage
+-------
+With '--dtype auto', the binary methods ('point', 'threshold', 'interior' and
+'exterior') are stored with one byte per cell (uint8), and the fractions of the
+method 'weight' in float32. The fractions can also be stored in 'uint8' or
+'uint16': values are then packed with the attribute 'scale_factor' (1/254 or
+1/65534), and unpacked by CF-compliant tools (netCDF4, xarray, ...). The
+largest value of the type (255 or 65535, the default fill value of netCDF) is
+the fill value, outside of the attribute 'valid_range', so fully covered cells
+are not read as missing. The precision is 2e-3 with 'uint8', and 8e-6 with
+'uint16'. With 'float64', the fractions are computed and stored as before.
+
+For a projected grid, the variables lat, lon, lat_bnds and lon_bnds are stored
+in float32 by default ('--coords-dtype auto'), about 1 meter of precision.
+The axes x / y (or lat / lon for epsg:4326) are always stored in float64.
+
+The 2d variables are chunked along the y / x axes (and by region with
+'--split-by'), so reading a sub-window only decompresses the chunks which
+intersect it. By default, chunks are squares of about 1MB: 1024x1024 cells for
+uint8, 512x512 for float32, and 256x256 for the bounds in float32. They can be
+given with '--chunks cy,cx'. The 1d axes are in one chunk.
+
+With '--output-format zarr' (the packages 'zarr' >= 3 and 'numcodecs' are
+required, e.g. 'pip install Shp2ncmask[zarr]'), the same variables and
+attributes are written in a zarr store (format version 2, with consolidated
+metadata), readable by xarray. Compression and chunks are
+given as for netcdf, except 'szip' which is not available. With
+'--tile-size', the chunks along the y / x axes are the tiles (or divide them),
+and each worker writes its tiles directly in the store, without lock.
+
+
+Engines
+-------
+The area fractions (all methods except 'point') are computed by one of the
+following engines:
+'intersect'
+    Each cell is a polygon (see the grid section) re-projected in the projection
+    of the shapefile, and intersected with the polygons of the shapefile. Areas
+    are computed in an equal-area projection.
+'clip'
+    Only if '--iepsg' and '--oepsg' are the same. The cells are rectangles of
+    the projection of the shapefile, and the polygons are directly clipped along
+    the lines of the grid, without building the cells. For a lat / lon grid,
+    the fractions are fractions of area (as for 'intersect'), otherwise they are
+    computed in the projection of the grid.
+'auto'
+    'clip' if '--iepsg' and '--oepsg' are the same, 'intersect' otherwise.
+
+With 'intersect', cells inside or outside the polygons are detected first from
+their bounding boxes, and only cells on the boundary are intersected. For very
+fine grids, '--quadtree N' tests instead blocks of NxN cells: blocks inside or
+outside are filled in one go, and only blocks crossing the boundary are split,
+down to single cells.
+
+A large polygon (e.g. a whole country with its coastline) covers most of the
+cells, so its bounding box prunes nothing and each cell is intersected with all
+its vertices. '--subdivide N' splits first the polygons in pieces of at most N
+vertices, by cutting recursively their bounding boxes in two (as ST_Subdivide of
+PostGIS). Each cell is then intersected only with the pieces near it, and the
+fractions of the pieces are summed per cell.
+
+Without '--split-by', the fractions of the polygons are summed per cell.
+Overlapping polygons are merged first (in parallel with '--workers'), so the
+fraction of a cell is the one of the union of the polygons. Polygons sharing
+only borders are kept apart. The weights stay the ones of each polygon.
+
+Polygons with much more details than the grid (e.g. coastlines) can be
+simplified first with '--simplify f': details smaller than f times the size of
+a cell are removed. If the polygons form a coverage (no overlap, shared
+borders with the same vertices, as administrative regions), shared borders are
+simplified once, so no gap or overlap appears between regions. A bound of the
+error (sum over the cells of the error of the fractions, in units of one cell)
+is given in the log.
+
+
+Weights
+-------
+With '--weights', the fraction of each cell covered by each feature (each region
+with '--split-by') is saved as a sparse matrix in coordinate format: the
+variables 'cell' (index j * nx + i of the cell), 'feature' (index of the
+feature) and 'weight' give the non-zero values. For example, the mean of a
+field over each feature is then a sparse matrix-vector product:
+    W = scipy.sparse.coo_matrix( (weight,(feature,cell)) , shape = (nfeature,ny*nx) )
+    mean = W @ field.ravel() / W.sum(1)
+Weights are always area weights, whatever the method. If no weight is non-zero
+(no polygon in the domain of the grid), the file is not written.
+
+
 Shapefile sources
 -----------------
 Two (not exhaustive) sources of shapefile are Natural Earth and GADM:
 - https://www.naturalearthdata.com/
 - https://gadm.org/download_country_v3.html
 
+Only the features intersecting the domain of the grid (re-projected in the
+projection of the shapefile) are read, with only the columns used by
+'--select' and '--split-by'. So large files (global coastlines, fine
+administrative levels) can be used to build the mask of a small domain.
+
 
 License {}
 -------{}
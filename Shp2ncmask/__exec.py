@@ -50,9 +50,23 @@ from .__curses_doc import print_doc
 from .__S2NParams  import s2nParams
 
 from .__grid import Grid
+from .__cache import GridCache
+from .__cache import MaskCache
+from .__cache import mask_cache_keys
+from .__cache import zarr_cache_keys
 from .__mask import build_mask
+from .__mask import cell_fractions
+from .__mask import prepare_features
+from .__tiles import save_netcdf_tiled
+from .__tiles import save_zarr_tiled
+from .__zarr import save_zarr
+from .__zarr import load_zarr_mask
 from .__mask import save_netcdf
 from .__plot import build_figure
+from .__weights import save_weights
+from .__weights import cell_weights
+from .__simplify import simplify_features
+from .__dissolve import dissolve_overlaps
 
 
 ##################
@@ -75,6 +89,44 @@ def normalize_str(s):
 		us = us.replace(c,"")
 	return us.lower()
 
+def sql_equal( col , value ):
+	"""
+	OGR SQL filter 'col = value', numbers are not quoted.
+	"""
+	if isinstance( value , (int,float,np.number) ):
+		return f'"{col}" = {value}'
+	value = str(value).replace( "'" , "''" )
+	return f'"{col}" = \'{value}\''
+
+def find_row( input , col , row , numeric = False ):
+	"""
+	Value of the column col of the shapefile input equal to row. The test is
+	done by the reader, on one feature, without geometry. Otherwise, the value
+	whose normalized string (see normalize_str) is the one of row is found in a
+	lookup table of the normalized values of the column.
+	"""
+	if numeric:
+		try:
+			row = float(row)
+			row = int(row) if row.is_integer() else row
+		except ValueError:
+			raise Exception( f"The row {row} is not in the column {col}" )
+	
+	if gpd.read_file( input , columns = [col] , ignore_geometry = True , where = sql_equal( col , row ) , rows = 1 ).shape[0] > 0:
+		return row
+	
+	logger.info( " * Try decoding" )
+	values = gpd.read_file( input , columns = [col] , ignore_geometry = True )[col].unique()
+	lookup = {}
+	for v in values:
+		lookup.setdefault( normalize_str(str(v)) , v )
+	urow = normalize_str(str(row))
+	logger.info( f" * Asked unirow: {urow}" )
+	if urow not in lookup:
+		raise Exception( f"The row {row} is not in the column {col}" )
+	
+	return lookup[urow]
+
 @log_start_end(logger)
 def run_shp2ncmask():##{{{
 	
@@ -83,22 +135,25 @@ def run_shp2ncmask():##{{{
 	iepsg    = s2nParams.iepsg
 	oepsg    = s2nParams.oepsg
 	ppe      = s2nParams.point_per_edge
+	max_err  = s2nParams.max_edge_error
 	select   = s2nParams.select
 	bounds   = s2nParams.bounds
 	list_col = s2nParams.list_columns
 	desc_col = s2nParams.describe_column
 	gparams  = s2nParams.grid
 	method   = s2nParams.method
+	split_by = s2nParams.split_by
 	
-	## Read the shapefile
+	## Read only the header (columns and projection) of the shapefile
 	logger.info( "Read input file" )
-	ish = gpd.read_file(input)
-	if not str(ish.crs.to_epsg()) == iepsg:
-		ish = ish.to_crs( epsg = int(iepsg) )
+	info = gpd.read_file( input , rows = 1 )
 	
 	## Bounds
 	if bounds:
 		logger.info( "Bounds is on, start" )
+		ish = gpd.read_file( input , columns = [] )
+		if not str(ish.crs.to_epsg()) == iepsg:
+			ish = ish.to_crs( epsg = int(iepsg) )
 		out = "xmin;xmax;ymin;ymax\n" + \
 		";".join(["{:.6f}".format(ish.bounds["minx"].min()),"{:.6f}".format(ish.bounds["maxx"].max()),"{:.6f}".format(ish.bounds["miny"].min()),"{:.6f}".format(ish.bounds["maxy"].max())])
 		logger.info(out)
@@ -108,7 +163,7 @@ def run_shp2ncmask():##{{{
 	## List columns
 	if list_col:
 		logger.info( "Print list of columns" )
-		out = ";".join( [c for c in ish.columns] )
+		out = ";".join( [c for c in info.columns] )
 		logger.info(out)
 		print(out)
 		return
@@ -117,6 +172,9 @@ def run_shp2ncmask():##{{{
 	if desc_col is not None:
 		logger.info( f"Describe column on for '{desc_col}'" )
 		try:
+			if desc_col not in info.columns:
+				raise Exception
+			ish = gpd.read_file( input , columns = [desc_col] , ignore_geometry = True )
 			out = "\n".join( [str(r) for r in ish[desc_col]] )
 			logger.info(out)
 			print(out)
@@ -124,45 +182,120 @@ def run_shp2ncmask():##{{{
 			logger.error( f"The column '{desc_col}' is not valid." )
 		return
 	
-	## If a selection
+	## Mask cache, the figure needs the full pipeline
+	mcache = None
+	if s2nParams.mask_cache_dir is not None and s2nParams.figure is None:
+		mcache  = MaskCache( s2nParams.mask_cache_dir , s2nParams.mask_cache_size )
+		mparams = { key : s2nParams[key] for key in mask_cache_keys }
+		if s2nParams.output_format == "zarr":
+			mparams.update( { key : s2nParams[key] for key in zarr_cache_keys } )
+		mfiles  = { "mask" : s2nParams.output }
+		if s2nParams.weights is not None:
+			mfiles["weights"] = s2nParams.weights
+		mkey    = mcache.key( input , mparams )
+		if mcache.load( mkey , mfiles ):
+			return
+	
+	## Columns needed by the selection and the split
+	columns = [ c for c in [ None if select is None else select[0] , split_by ] if c is not None ]
+	for col in columns:
+		if col not in info.columns:
+			raise Exception( f"Column '{col}' is not a column." )
+	
+	## If a selection, find the row, and filter the features when they are read
+	where = None
 	if select is not None:
 		col,row = select
 		logger.info( f"Selection of '{col}' / '{row}'..." )
-
-		## Check if column is valid
-		if col not in ish.columns:
-			raise Exception( f"Column '{col}' is not a column." )
-		
-		## Check if row is valid
-		if row not in ish[col]:
-			logger.info( " * Try decoding" )
-			rows  = np.unique(ish[col].values).tolist()
-			urows = [normalize_str(s) for s in rows]
-			urow  = normalize_str(row)
-			logger.info( f" * List of unirows: " + ", ".join(urows) )
-			logger.info( f" * Asked unirow: {urow}" )
-			if urow not in urows:
-				raise Exception( f"The row {row} is not in the column {col}" )
-			row = rows[urows.index(urow)]
-		
-		ish = ish[ish[col] == row]
-		if ish.size == 0:
-			raise Exception( f"Data are empty after selection, maybe the row '{row}' is not valid ?".format(row) )
-		logger.info( "Selection OK" )
-	
+		row   = find_row( input , col , row , numeric = info[col].dtype.kind in "iuf" )
+		where = sql_equal( col , row )
+		logger.info( f"Selection OK: {where}" )
 	
 	## Build the grid
-	grid = Grid( gparams[:3] , gparams[3:] , epsg = oepsg , ppe = ppe )
+	cache = None if s2nParams.cache_dir is None else GridCache( s2nParams.cache_dir , s2nParams.cache_size )
+	grid  = Grid( gparams[:3] , gparams[3:] , epsg = oepsg , ppe = ppe , cache = cache )
+	if max_err is not None:
+		grid.adapt_ppe( iepsg , max_err )
+	
+	## Read the features intersecting the domain of the grid, and of the
+	## selection, and only the columns needed
+	bbox = None
+	if info.crs is not None:
+		bbox = grid.extent( info.crs )
+		logger.info( " * Bounding box in the projection of the file: " + ", ".join( ["{:.6f}".format(b) for b in bbox] ) )
+	ish = gpd.read_file( input , columns = columns , bbox = bbox , where = where , fid_as_index = True )
+	logger.info( f" * {ish.shape[0]} feature(s) read" )
+	if not str(ish.crs.to_epsg()) == iepsg:
+		ish = ish.to_crs( epsg = int(iepsg) )
+	
+	## Selection
+	if select is not None:
+		if ish.shape[0] == 0:
+			logger.warning( f"The row '{row}' has no feature in the domain of the grid" )
+	
+	## If a split, one feature per region
+	regions = None
+	if split_by is not None:
+		logger.info( f"Split by '{split_by}'..." )
+		ish     = ish[[split_by,"geometry"]].dissolve( by = split_by ).reset_index()
+		regions = [str(r) for r in ish[split_by]]
+		if len(regions) == 0:
+			raise Exception( f"No feature in the domain of the grid, no region of '{split_by}' to split" )
+		logger.info( f" * {len(regions)} regions: " + ", ".join(regions) )
+	
+	## Simplify the features at the resolution of the grid
+	if s2nParams.simplify is not None:
+		ish = simplify_features( ish , grid , s2nParams.simplify )
+	
+	## Without split, overlapping features are merged, so the fractions of the
+	## features of the mask are summed per cell. Weights stay per feature
+	fish = ish
+	if split_by is None:
+		ish = dissolve_overlaps( fish , s2nParams.workers )
 	
-	## Build the mask
-	mask = build_mask( grid , ish )
+	## Work on the features done once, and shared by all tiles. Features
+	## merged by dissolve_overlaps do not overlap. The unmerged features are
+	## only used for the weights
+	prep  = prepare_features( grid , ish , overlap = split_by is not None )
+	fprep = None
+	if s2nParams.weights is not None:
+		fprep = prep if fish is ish else prepare_features( grid , fish )
 	
-	## Save in netcdf
-	save_netcdf( mask , grid )
+	## Build the mask, and the weights if asked, and save in netcdf or zarr.
+	## With tiles, each tile is written as soon as it is computed
+	zarr_out  = s2nParams.output_format == "zarr"
+	fractions = None
+	weights   = None
+	if s2nParams.tile_size is None:
+		if s2nParams.weights is not None and fish is ish:
+			fractions = cell_fractions( grid , ish , prep )
+		mask = build_mask( grid , ish , fractions , prep )
+		if zarr_out:
+			save_zarr( mask , grid , regions )
+		else:
+			save_netcdf( mask , grid , regions )
+	else:
+		save_tiled = save_zarr_tiled if zarr_out else save_netcdf_tiled
+		weights    = save_tiled( grid , ish , s2nParams.tile_size , s2nParams.workers , regions , fish , prep , fprep )
+	if s2nParams.weights is not None:
+		if weights is None:
+			weights = cell_weights( grid , cell_fractions( grid , fish , fprep ) if fractions is None else fractions )
+		if not save_weights( grid , fish , weights , regions ) and mcache is not None:
+			mfiles["weights"] = None
+	if mcache is not None:
+		mcache.save( mkey , mfiles , mparams )
+	if cache is not None:
+		cache.evict()
 	
 	## Figure
 	if s2nParams.figure is not None:
-		build_figure( grid , ish , mask )
+		if s2nParams.tile_size is not None:
+			if zarr_out:
+				mask = load_zarr_mask( s2nParams.output )
+			else:
+				with netCDF4.Dataset( s2nParams.output ) as ncf:
+					mask = np.array( ncf["area_fraction"][:] )
+		build_figure( grid , ish , mask if regions is None else np.minimum( mask.sum(0) , 1 ) )
 	
 ##}}}
 
@@ -20,14 +20,17 @@
 ## Packages ##
 ##############
 
-import itertools as itt
 import datetime as dt
 import logging
 import numpy     as np
 import geopandas as gpd
-from shapely.geometry import Point,MultiPoint,Polygon,MultiPolygon
+import shapely
 import pyproj
 
+from .__proj import get_transformer
+from .__proj import transform_xy
+from .__proj import transform_geoms
+
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 for mod in ["numpy","geopandas","fiona"]:
@@ -52,9 +55,17 @@ class Grid:
 	- pt is a GeoDataFrame describing all center of the cells
 	- lat is the array (1d or 2d) of latitude, equal to y if epsg == 4326
 	- lon is the array (1d or 2d) of longitude, equal to x if epsg == 4326
+	- lat_bnds and lon_bnds are the bounds of the cells, None if epsg == 4326
+	- cache is an optional GridCache, where the arrays built are saved and
+	  re-loaded by the next grids with the same parameters
+	- root and offset are the full grid of a subgrid and the offset (j,i) of
+	  its cells in it (the grid itself and (0,0) otherwise)
+	
+	X, Y, sq, pt, lat, lon, lat_bnds and lon_bnds are built at the first
+	access, and kept in memory after.
 	"""
 	
-	def __init__( self , xparams , yparams , epsg = 4326 , ppe = 100 ):##{{{
+	def __init__( self , xparams , yparams , epsg = 4326 , ppe = 100 , cache = None ):##{{{
 		
 		logger.info(f"shp2ncmask:Grid:__init__:start")
 		time0 = dt.datetime.utcnow()
@@ -62,29 +73,24 @@ class Grid:
 		
 		self.xparams = xparams
 		self.yparams = yparams
-		self.epsg    = epsg
+		self.epsg    = str(epsg)
 		self.ppe     = ppe ## point per edge
+		self.cache   = cache
+		self.root    = self   ## Full grid, and offset (j,i) of the cells in it
+		self.offset  = (0,0)
 		
 		self.x  = np.arange( self.xmin , self.xmax + self.dx / 2 , self.dx )
 		self.y  = np.arange( self.ymin , self.ymax + self.dy / 2 , self.dy )
-		X,Y     = np.meshgrid(self.x,self.y)
-		self.X  = X.ravel()
-		self.Y  = Y.ravel()
-		logger.info(" * Build projected squares")
-		self.sq = gpd.GeoDataFrame( [ {"geometry" : Polygon(self.build_square(x,y)) }  for x,y in zip(self.X,self.Y) ] , crs = "EPSG:{}".format(self.epsg) )
-		self.sq["INDEX"] = range(self.nx*self.ny)
-		
-		logger.info(" * Build projected points")
-		self.pt = gpd.GeoDataFrame( [ {"geometry" : Point(x,y) }  for x,y in zip(self.X,self.Y) ] , crs = "EPSG:{}".format(self.epsg) )
-		self.pt["INDEX"] = range(self.nx*self.ny)
 		
-		self.lat = None
-		self.lon = None
-		self._build_latlon()
-		
-		self.lat_bnds = None
-		self.lon_bnds = None
-		self._build_latlon_bnds()
+		## Lazy members
+		self._X        = None
+		self._Y        = None
+		self._sq       = None
+		self._pt       = None
+		self._lat      = None
+		self._lon      = None
+		self._lat_bnds = None
+		self._lon_bnds = None
 		
 		time1 = dt.datetime.utcnow()
 		logger.info(f"shp2ncmask:Grid:__init__:walltime:{time1-time0}")
@@ -92,56 +98,317 @@ class Grid:
 		
 	##}}}
 	
-	def build_square( self , x , y ): ##{{{
-		xy_lt = np.array( [x-self.dx/2,y+self.dy/2] )
-		xy_rt = np.array( [x+self.dx/2,y+self.dy/2] )
-		xy_lb = np.array( [x-self.dx/2,y-self.dy/2] )
-		xy_rb = np.array( [x+self.dx/2,y-self.dy/2] )
+	def square_template(self): ##{{{
+		"""
+		Offsets of the vertices of a cell from its center. Each edge is
+		described by 'ppe' points, the last one is the first of the next
+		edge, so the ring has 4*(ppe-1) vertices (clockwise, from the top
+		left corner).
+		"""
+		xy_lt = np.array( [-self.dx/2, self.dy/2] )
+		xy_rt = np.array( [ self.dx/2, self.dy/2] )
+		xy_lb = np.array( [-self.dx/2,-self.dy/2] )
+		xy_rb = np.array( [ self.dx/2,-self.dy/2] )
+		
+		g = np.linspace(0,1,self.ppe)[:-1].reshape(-1,1)
+		sq = [ (1-g) * xy0 + g * xy1 for xy0,xy1 in zip([xy_lt,xy_rt,xy_rb,xy_lb],[xy_rt,xy_rb,xy_lb,xy_lt]) ]
 		
-		sq = []
-		for g in np.linspace(0,1,self.ppe)[:-1]:
-			sq.append( (1-g) * xy_lt + g * xy_rt )
-		for g in np.linspace(0,1,self.ppe)[:-1]:
-			sq.append( (1-g) * xy_rt + g * xy_rb )
-		for g in np.linspace(0,1,self.ppe)[:-1]:
-			sq.append( (1-g) * xy_rb + g * xy_lb )
-		for g in np.linspace(0,1,self.ppe)[:-1]:
-			sq.append( (1-g) * xy_lb + g * xy_lt )
+		return np.concatenate( sq , axis = 0 )
+	##}}}
+	
+	def build_squares( self , X , Y , block = 2**22 ): ##{{{
+		"""
+		Build the polygons of the cells centered at (X,Y). The coordinates of
+		all rings are built as one array and converted in one shot by shapely,
+		by blocks of at most 'block' vertices to bound the memory.
+		"""
+		tpl  = self.square_template()
+		X    = np.asarray(X).ravel()
+		Y    = np.asarray(Y).ravel()
+		sq   = np.empty( X.size , dtype = object )
+		step = max( 1 , block // tpl.shape[0] )
+		for i0 in range(0,X.size,step):
+			i1 = min( i0 + step , X.size )
+			xy = np.stack( (X[i0:i1],Y[i0:i1]) , -1 )[:,None,:] + tpl[None,:,:]
+			sq[i0:i1] = shapely.polygons(xy)
 		
 		return sq
 	##}}}
 	
+	def tiles( self , size ):##{{{
+		"""
+		List of tiles (j0,j1,i0,i1) of at most size x size cells covering the
+		grid.
+		"""
+		return [ (j0,min(j0+size,self.ny),i0,min(i0+size,self.nx)) for j0 in range(0,self.ny,size) for i0 in range(0,self.nx,size) ]
+	##}}}
+	
+	def subgrid( self , j0 , j1 , i0 , i1 ):##{{{
+		"""
+		Grid of the cells [j0:j1,i0:i1], with the same coordinates, epsg and
+		point per edge.
+		"""
+		sub   = Grid( [self.x[i0],self.x[i1-1],self.dx] , [self.y[j0],self.y[j1-1],self.dy] , epsg = self.epsg , ppe = self.ppe , cache = self.cache )
+		sub.x = self.x[i0:i1]
+		sub.y = self.y[j0:j1]
+		sub.root   = self.root
+		sub.offset = ( self.offset[0] + j0 , self.offset[1] + i0 )
+		return sub
+	##}}}
+	
+	def squares( self , idx , epsg = None ):##{{{
+		"""
+		Polygons of the cells idx (index in the flattened grid), re-projected in
+		epsg if given.
+		"""
+		sq = self.build_squares( self.X[idx] , self.Y[idx] )
+		if epsg is not None:
+			sq = transform_geoms( sq , self.epsg , epsg )
+		return sq
+	##}}}
+	
+	def _from_cache( self , name , build ):##{{{
+		"""
+		Array name loaded from the cache, or built by build() and saved in the
+		cache. Without cache, just build(). The array is of shape (ny,nx,...),
+		see GridCache.
+		"""
+		if self.cache is None:
+			return build()
+		array = self.cache.load( self , name )
+		if array is None:
+			array = build()
+			self.cache.save( self , name , array )
+		return array
+	##}}}
+	
+	def envelopes( self , epsg , block = 2**22 ):##{{{
+		"""
+		Bounds (xmin,ymin,xmax,ymax) of the cells re-projected in epsg, as four
+		flattened arrays. They are computed from the vertices of the edges (see
+		square_template) along the lines of the grid, re-projected as arrays by
+		blocks of rows, without building the cells.
+		"""
+		bnds = self._from_cache( f"envelopes_{epsg}" , lambda: np.stack( self._build_envelopes( epsg , block ) , -1 ).reshape(self.ny,self.nx,4) )
+		return tuple( bnds[...,k].ravel() for k in range(4) )
+	##}}}
+	
+	def _build_envelopes( self , epsg , block ):##{{{
+		n  = self.ppe - 1
+		g  = np.linspace(0,1,self.ppe)[:-1]
+		xl = np.hstack( ( (self.xc[:-1].reshape(-1,1) + g * self.dx).ravel() , self.xc[-1] ) )
+		yl = np.hstack( ( (self.yc[:-1].reshape(-1,1) + g * self.dy).ravel() , self.yc[-1] ) )
+		
+		## Min / max over the n+1 vertices of each edge of a line
+		def reduce( T , f ):
+			return f( f.reduce( T[:,:-1].reshape(T.shape[0],-1,n) , axis = 2 ) , T[:,n::n] )
+		
+		bnds = [ np.zeros( (self.ny,self.nx) ) for _ in range(4) ]
+		step = max( 1 , block // ( 2 * self.nx * n ) )
+		for j0 in range(0,self.ny,step):
+			j1 = min( j0 + step , self.ny )
+			
+			## Horizontal lines (bottom / top edges) and vertical lines (left / right edges)
+			HX,HY = transform_xy( xl.reshape(1,-1) + np.zeros((j1-j0+1,1)) , self.yc[j0:j1+1].reshape(-1,1) + np.zeros((1,xl.size)) , self.epsg , epsg )
+			VX,VY = transform_xy( self.xc.reshape(-1,1) + np.zeros((1,(j1-j0)*n+1)) , yl[j0*n:j1*n+1].reshape(1,-1) + np.zeros((self.nx+1,1)) , self.epsg , epsg )
+			
+			for k,(H,V,f) in enumerate(zip([HX,HY,HX,HY],[VX,VY,VX,VY],[np.minimum,np.minimum,np.maximum,np.maximum])):
+				H = reduce( np.asarray(H) , f )
+				V = reduce( np.asarray(V) , f ).T
+				bnds[k][j0:j1,:] = f( f( H[:-1,:] , H[1:,:] ) , f( V[:,:-1] , V[:,1:] ) )
+		
+		return tuple( b.ravel() for b in bnds )
+	##}}}
+	
+	def _edge_error( self , xs , ys , epsg , ppe ):##{{{
+		"""
+		Maximal distance (in units of the grid) between the edges starting at
+		the corners xs x ys, and the same edges described by ppe points and
+		re-projected in epsg. Only the component orthogonal to the edge is
+		measured.
+		"""
+		g  = np.linspace(0,1,ppe)
+		
+		err = 0
+		for dx,dy in [(self.dx,0),(0,self.dy)]:
+			
+			## Points along the edges, and middle of the chords in epsg
+			XA = xs.reshape(1,-1,1) + g.reshape(1,1,-1) * dx + np.zeros_like(ys).reshape(-1,1,1)
+			YA = ys.reshape(-1,1,1) + g.reshape(1,1,-1) * dy + np.zeros_like(xs).reshape(1,-1,1)
+			TX,TY = transform_xy( XA , YA , self.epsg , epsg )
+			TX = ( TX[...,1:] + TX[...,:-1] ) / 2
+			TY = ( TY[...,1:] + TY[...,:-1] ) / 2
+			
+			## And go back in the grid projection
+			XB,YB = transform_xy( TX , TY , epsg , self.epsg )
+			if dy == 0:
+				e = np.abs( YB - YA[...,1:] )
+			else:
+				e = np.abs( XB - XA[...,1:] )
+			e = e[np.isfinite(e)]
+			if e.size > 0:
+				err = max( err , e.max() )
+		
+		return err
+	##}}}
+	
+	def adapt_ppe( self , epsg , max_error , nsample = 100 ):##{{{
+		"""
+		Choose the number of points per edge such that, once the cells are
+		re-projected in epsg, the straight segments between two points deviate
+		from the true edges by less than max_error (in units of the grid). The
+		error is estimated on a sub-sample of nsample x nsample corners, and
+		the current ppe is the maximal value. If the projections are the same,
+		only the corners are kept.
+		"""
+		ppe_max = self.ppe
+		if str(epsg) == self.epsg:
+			ppe = 2
+		else:
+			xs  = self.xc[:-1][::max(1,self.nx // nsample)]
+			ys  = self.yc[:-1][::max(1,self.ny // nsample)]
+			ppe = 2
+			while ppe < ppe_max and self._edge_error( xs , ys , epsg , ppe ) > max_error:
+				ppe = 2 * ppe - 1
+			ppe = min( ppe , ppe_max )
+		
+		if not ppe == self.ppe:
+			self.ppe   = ppe
+			self._sq   = None
+		logger.info( f" * Point per edge: {self.ppe}" )
+	##}}}
+	
+	def extent( self , crs ):##{{{
+		"""
+		Bounds (xmin,ymin,xmax,ymax) of the domain of the grid re-projected in
+		crs (anything accepted by pyproj.CRS). The boundary of the domain is
+		densified, and crossings of the antimeridian are handled by pyproj.
+		"""
+		transf = pyproj.Transformer.from_crs( self.crs , pyproj.CRS(crs) , always_xy = True )
+		return transf.transform_bounds( self.xc[0] , self.yc[0] , self.xc[-1] , self.yc[-1] , densify_pts = min( 4 * max(self.nx,self.ny) , 10000 ) )
+	##}}}
+	
+	def transform( self , epsg ):##{{{
+		"""
+		Coordinates (flattened) of the centers of the cells in the projection
+		epsg. No geometry is built.
+		"""
+		return transform_xy( self.X , self.Y , self.epsg , epsg )
+	##}}}
+	
+	def _build_sq(self):##{{{
+		logger.info(" * Build projected squares")
+		sq = self.build_squares( self.X , self.Y )
+		self._sq = gpd.GeoDataFrame( { "INDEX" : np.arange(self.nx*self.ny) } , geometry = sq , crs = self.crs )
+	##}}}
+	
+	def _build_pt(self):##{{{
+		logger.info(" * Build projected points")
+		self._pt = gpd.GeoDataFrame( { "INDEX" : np.arange(self.nx*self.ny) } , geometry = shapely.points( self.X , self.Y ) , crs = self.crs )
+	##}}}
+	
 	def _build_latlon(self):##{{{
 		if self.epsg == "4326":
-			self.lon,self.lat = self.x,self.y
+			self._lon,self._lat = self.x,self.y
 			return
 		
-		logger.info(" * Build lat-lon coordinates")
+		def build():
+			logger.info(" * Build lat-lon coordinates")
+			return np.stack( self.transform(4326) , -1 ).reshape(self.ny,self.nx,2)
 		
-		latlon   = np.array( [ np.asarray(geo.coords) for geo in self.pt.to_crs( epsg = 4326 )["geometry"] ] ).reshape(-1,2)
-#		latlon   = np.array( [ np.array( geo.array_interface()["data"]) for geo in self.pt.to_crs( epsg = 4326 )["geometry"] ] ).reshape(-1,2)
-		self.lon = latlon[:,0].reshape(self.ny,self.nx)
-		self.lat = latlon[:,1].reshape(self.ny,self.nx)
+		lonlat    = self._from_cache( "lonlat" , build )
+		self._lon = lonlat[...,0]
+		self._lat = lonlat[...,1]
 		
 	##}}}
 	
 	def _build_latlon_bnds(self):##{{{
 		if self.epsg == "4326":
 			return
-		logger.info(" * Build lat-lon bounds")
-		self.lat_bnds = np.zeros( (self.y.size,self.x.size,4) ) + np.nan
-		self.lon_bnds = np.zeros( (self.y.size,self.x.size,4) ) + np.nan
-		
-		transf = pyproj.Transformer.from_crs( int(self.epsg) , 4326 )
-		for j,i in itt.product(range(self.y.size),range(self.x.size)):
-			for ji,sy,sx in zip([0,1,2,3],[-1,-1,1,1],[-1,1,1,-1]):
-				self.lat_bnds[j,i,ji],self.lon_bnds[j,i,ji] = transf.transform( yy = self.y[j] + sy * self.dy / 2 , xx = self.x[i] + sx * self.dx / 2 )
-		
 		
+		def build():
+			logger.info(" * Build lat-lon bounds")
+			
+			## The corners are shared between cells, so we transform the
+			## (ny+1)x(nx+1) lattice of corners once
+			XC,YC = np.meshgrid( self.xc , self.yc )
+			
+			lonc,latc = get_transformer( self.epsg , "4326" ).transform( XC , YC )
+			
+			## Corners are ordered as: left-bottom, right-bottom, right-top, left-top
+			lat_bnds = np.stack( (latc[:-1,:-1],latc[:-1,1:],latc[1:,1:],latc[1:,:-1]) , -1 )
+			lon_bnds = np.stack( (lonc[:-1,:-1],lonc[:-1,1:],lonc[1:,1:],lonc[1:,:-1]) , -1 )
+			return np.stack( (lon_bnds,lat_bnds) , 2 )
 		
+		bnds = self._from_cache( "lonlat_bnds" , build )
+		self._lon_bnds = bnds[:,:,0]
+		self._lat_bnds = bnds[:,:,1]
+	##}}}
+	
+	## Lazy properties ##{{{
+	@property
+	def X(self):
+		if self._X is None:
+			self._X = np.meshgrid(self.x,self.y)[0].ravel()
+		return self._X
+	
+	@property
+	def Y(self):
+		if self._Y is None:
+			self._Y = np.meshgrid(self.x,self.y)[1].ravel()
+		return self._Y
+	
+	@property
+	def sq(self):
+		if self._sq is None:
+			self._build_sq()
+		return self._sq
+	
+	@property
+	def pt(self):
+		if self._pt is None:
+			self._build_pt()
+		return self._pt
+	
+	@property
+	def lat(self):
+		if self._lat is None:
+			self._build_latlon()
+		return self._lat
+	
+	@property
+	def lon(self):
+		if self._lon is None:
+			self._build_latlon()
+		return self._lon
+	
+	@property
+	def lat_bnds(self):
+		if self._lat_bnds is None:
+			self._build_latlon_bnds()
+		return self._lat_bnds
+	
+	@property
+	def lon_bnds(self):
+		if self._lon_bnds is None:
+			self._build_latlon_bnds()
+		return self._lon_bnds
+	
 	##}}}
 	
 	## Properties ##{{{
+	@property
+	def crs(self):
+		return pyproj.CRS.from_epsg(int(self.epsg))
+	
+	@property
+	def xc(self):
+		return np.hstack( (self.x - self.dx / 2 , self.x[-1] + self.dx / 2) )
+	
+	@property
+	def yc(self):
+		return np.hstack( (self.y - self.dy / 2 , self.y[-1] + self.dy / 2) )
+	
 	@property
 	def xmin(self):
 		return self.xparams[0]
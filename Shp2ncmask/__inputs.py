@@ -54,15 +54,36 @@ def read_inputs(*argv):##{{{
 	parser.add_argument( "--list-columns" , action = "store_const" , const = True , default = False )
 	parser.add_argument( "--describe-column" )
 	parser.add_argument( "--select"            , nargs = 2 )
+	parser.add_argument( "--split-by"          )
 	parser.add_argument( "--log"               , nargs = '*' , default = ["WARNING"] )
 	parser.add_argument( "--input"             )
 	parser.add_argument( "--output"            )
+	parser.add_argument( "--output-format"     , default = "auto"  , type = str )
+	parser.add_argument( "--weights"           )
+	parser.add_argument( "--weights-value"     , default = "fraction" , type = str )
 	parser.add_argument( "--grid"              )
 	parser.add_argument( "--method"            , default = "point" , type = str )
 	parser.add_argument( "--threshold"         , default = 0.8     , type = float )
+	parser.add_argument( "--dtype"             , default = "auto"  , type = str )
+	parser.add_argument( "--coords-dtype"      , default = "auto"  , type = str )
+	parser.add_argument( "--chunks"            )
+	parser.add_argument( "--compression"       , default = "zlib"  , type = str )
+	parser.add_argument( "--complevel"         , default = 5       , type = int )
+	parser.add_argument( "--shuffle"           , action = "store_const" , const = True , default = False )
+	parser.add_argument( "--engine"            , default = "auto"  , type = str )
+	parser.add_argument( "--quadtree"          , nargs = "?" , const = 64 , default = None , type = int )
+	parser.add_argument( "--subdivide"         , nargs = "?" , const = 256 , default = None , type = int )
+	parser.add_argument( "--simplify"          , nargs = "?" , const = 0.1 , default = None , type = float )
+	parser.add_argument( "--tile-size"         , default = None    , type = int )
+	parser.add_argument( "--workers"           , default = 1       , type = int )
 	parser.add_argument( "--iepsg"             , default = "4326"  , type = str )
 	parser.add_argument( "--oepsg"             , default = "4326"  , type = str )
 	parser.add_argument( "--point-per-edge"    , default = 100     , type = int )
+	parser.add_argument( "--max-edge-error"    , default = None    , type = float )
+	parser.add_argument( "--cache-dir"         )
+	parser.add_argument( "--cache-size"        , default = 1024    , type = float )
+	parser.add_argument( "--mask-cache-dir"    )
+	parser.add_argument( "--mask-cache-size"   , default = 1024    , type = float )
 	parser.add_argument( "--figure"            )
 	parser.add_argument( "--fepsg"             , default = "4326"  , type = str )
 	
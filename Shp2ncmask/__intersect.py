@@ -0,0 +1,173 @@
+
+## Copyright(c) 2023 Yoann Robin
+## 
+## This file is part of Shp2ncmask.
+## 
+## Shp2ncmask is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+## 
+## Shp2ncmask is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+## 
+## You should have received a copy of the GNU General Public License
+## along with Shp2ncmask.  If not, see <https://www.gnu.org/licenses/>.
+
+##############
+## Packages ##
+##############
+
+import logging
+import numpy   as np
+import shapely
+
+from .__area      import area
+from .__quadtree  import quadtree_classify
+from .__subdivide import sum_pieces
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+###############
+## Functions ##
+###############
+
+def classify_cells( bounds , features ):##{{{
+	"""
+	Shp2ncmask.classify_cells
+	=========================
+	
+	Cheap classification of cells from their bounds (xmin,ymin,xmax,ymax), in
+	the projection of the features.
+	
+	An STR-tree of the features gives in bulk the pairs (cell,feature) whose
+	bounding boxes intersect; cells without pair are outside. A bounding box
+	contained in a prepared feature means the cell is inside. Remaining pairs
+	are on a boundary, and are the only ones which need an exact computation.
+	
+	Returns
+	-------
+	inside: array, index of a feature containing the cell, -1 otherwise
+	icell: array of index of the cells of the boundary pairs
+	ifeat: array of index of the features of the boundary pairs
+	"""
+	
+	features = np.asarray(features)
+	boxes    = shapely.box( *bounds )
+	
+	tree = shapely.STRtree(features)
+	icell,ifeat = tree.query( boxes , predicate = "intersects" )
+	
+	shapely.prepare(features)
+	cont   = shapely.contains( features[ifeat] , boxes[icell] )
+	inside = np.zeros( boxes.size , dtype = int ) - 1
+	inside[icell[cont]] = ifeat[cont]
+	
+	keep = inside[icell] < 0
+	logger.info( f" * Classification: {(inside > -1).sum()} cells inside, {np.unique(icell[keep]).size} on a boundary" )
+	
+	return inside,icell[keep],ifeat[keep]
+##}}}
+
+def intersect_fractions( grid , features , epsg , quadtree = None , pieces = None ):##{{{
+	"""
+	Shp2ncmask.intersect_fractions
+	==============================
+	
+	Area fractions of the cells of the grid covered by the features, which are
+	in the projection epsg.
+	
+	Cells are first classified (see classify_cells, or quadtree_classify if
+	quadtree is the size of the blocks), and only cells on a boundary are
+	built, intersected with the features and measured in an equal-area
+	projection.
+	
+	If given, pieces is the output of subdivide for the features (pieces with
+	a bounded number of vertices, and their feature): the STR-tree prunes
+	more, and each cell is intersected with the few vertices near it. The
+	fractions of the pieces are then summed per cell and feature.
+	
+	Returns
+	-------
+	icell: array of index of the cells
+	ifeat: array of index of the features
+	frac: array of the fraction of the cell icell covered by the feature ifeat.
+	      Pairs of cells inside a feature come last.
+	"""
+	
+	features = np.asarray(features)
+	owner    = None
+	if pieces is not None:
+		features,owner = pieces
+	
+	if quadtree is None:
+		inside,icell,ifeat = classify_cells( grid.envelopes(epsg) , features )
+	else:
+		inside,icell,ifeat = quadtree_classify( grid , features , epsg , quadtree )
+	
+	## Exact fractions on the boundary
+	ub,pos = np.unique( icell , return_inverse = True )
+	cells  = grid.squares( ub , epsg )
+	full   = shapely.contains( features[ifeat] , cells[pos] )
+	frac   = np.ones(icell.size)
+	pieces = shapely.intersection( cells[pos[~full]] , features[ifeat[~full]] )
+	frac[~full] = np.minimum( area( pieces , epsg ) / area( cells , epsg )[pos[~full]] , 1 )
+	
+	## Add cells inside
+	cin   = np.flatnonzero( inside > -1 )
+	icell = np.hstack( (icell,cin) )
+	ifeat = np.hstack( (ifeat,inside[cin]) )
+	frac  = np.hstack( (frac,np.ones(cin.size)) )
+	
+	## Sum the pieces back per feature
+	if owner is not None:
+		icell,ifeat,frac = sum_pieces( icell , ifeat , frac , owner )
+	
+	return icell,ifeat,frac
+##}}}
+
+def points_in_features( x , y , features , pieces = None ):##{{{
+	"""
+	Shp2ncmask.points_in_features
+	=============================
+	
+	Array of the index of a feature intersected (interior or boundary) by the
+	point (x,y), -1 otherwise. x, y and features are in the same projection.
+	
+	Points are sorted along x once, so the candidates of a feature are found
+	from its bounding box by a binary search, and tested against the prepared
+	feature in one vectorized call. No point geometry is built. If given,
+	pieces is the output of subdivide for the features, whose bounding boxes
+	give much fewer candidates.
+	"""
+	
+	x = np.asarray(x).ravel()
+	y = np.asarray(y).ravel()
+	features = np.asarray(features)
+	
+	if pieces is not None:
+		inside = points_in_features( x , y , pieces[0] )
+		inside[inside > -1] = pieces[1][inside[inside > -1]]
+		return inside
+	
+	inside = np.zeros( x.size , dtype = int ) - 1
+	order  = np.argsort( x , kind = "stable" )
+	xs     = x[order]
+	
+	shapely.prepare(features)
+	for k,(feat,(xmin,ymin,xmax,ymax)) in enumerate(zip(features,shapely.bounds(features))):
+		if shapely.is_empty(feat):
+			continue
+		i0    = np.searchsorted( xs , xmin , side = "left"  )
+		i1    = np.searchsorted( xs , xmax , side = "right" )
+		cand  = order[i0:i1]
+		cand  = cand[(y[cand] >= ymin) & (y[cand] <= ymax) & (inside[cand] < 0)]
+		inside[cand[shapely.intersects_xy( feat , x[cand] , y[cand] )]] = k
+	
+	return inside
+##}}}
+
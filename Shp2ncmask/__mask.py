@@ -23,7 +23,6 @@
 import logging
 import datetime  as dt
 import numpy     as np
-import geopandas as gpd
 import netCDF4
 import pyproj
 
@@ -31,6 +30,17 @@ from .__logs      import log_start_end
 from .__release   import version
 from .__release   import src_url
 from .__S2NParams import s2nParams
+from .__clip      import clip_fraction
+from .__clip      import clip_windows
+from .__intersect import intersect_fractions
+from .__intersect import points_in_features
+from .__dissolve  import overlap_layers
+from .__subdivide import subdivide
+from .__storage   import fraction_dtype
+from .__storage   import mask_dtype
+from .__storage   import mask_encoding
+from .__storage   import coords_encoding
+from .__storage   import nc_encoding
 
 
 #############
@@ -47,43 +57,157 @@ for mod in ["numpy","geopandas","fiona"]:
 ## Functions ##
 ###############
 
+def find_engine( grid , epsg ):##{{{
+	"""
+	Engine used for the area fractions. Without re-projection, cells are
+	rectangles of the shapefile projection, and the features are directly
+	clipped on the grid.
+	"""
+	engine = s2nParams.engine
+	if engine == "auto":
+		engine = "clip" if str(epsg) == grid.epsg else "intersect"
+	return engine
+##}}}
+
+def prepare_features( grid , ish , overlap = True ):##{{{
+	"""
+	Work on the features of ish done once per run, and shared by all the
+	calls of cell_fractions and build_mask (one per tile), as a dict:
+	- layer: layer of each feature, such that the features of a layer do not
+	  overlap (see overlap_layers). Only computed if needed by the engine
+	  'intersect' or the method 'point', and if overlap is True; features
+	  known to not overlap (e.g. merged by dissolve_overlaps) are all in the
+	  layer 0.
+	- pieces: with '--subdivide', the pieces of the features and their feature
+	  (see subdivide), None otherwise.
+	"""
+	features = ish.geometry.to_numpy()
+	used     = s2nParams.method == "point" or find_engine( grid , ish.crs.to_epsg() ) == "intersect"
+	layer    = np.zeros( features.size , dtype = int )
+	if overlap and features.size > 1 and used:
+		layer = overlap_layers(features)
+	
+	pieces = None
+	if s2nParams.subdivide is not None and used:
+		pieces = subdivide( features , s2nParams.subdivide )
+	
+	return { "layer" : layer , "pieces" : pieces }
+##}}}
+
+def layer_features( prep , l ):##{{{
+	"""
+	Index of the features of the layer l (see prepare_features), and their
+	pieces, with the index of their feature in the layer (None without
+	subdivision).
+	"""
+	layer  = prep["layer"]
+	idx    = np.flatnonzero( layer == l )
+	pieces = prep["pieces"]
+	if pieces is not None:
+		sel    = layer[pieces[1]] == l
+		pieces = ( pieces[0][sel] , np.searchsorted( idx , pieces[1][sel] ) )
+	return idx,pieces
+##}}}
+
+def cell_fractions( grid , ish , prep = None ):##{{{
+	"""
+	Sparse area fractions of the cells of the grid covered by each feature of
+	ish, as three arrays (icell,ifeat,frac). A pair (cell,feature) appears at
+	most once. With the engine 'intersect', overlapping features are split in
+	layers of features without overlap (see prepare_features, computed if prep
+	is not given), computed one after the other, so a cell inside several
+	features is paired with each.
+	"""
+	features = ish.geometry.to_numpy()
+	epsg     = ish.crs.to_epsg()
+	
+	if find_engine( grid , epsg ) == "intersect":
+		if prep is None:
+			prep = prepare_features( grid , ish )
+		layer = prep["layer"]
+		icell,ifeat,frac = [],[],[]
+		for l in range(layer.max() + 1 if layer.size > 0 else 1):
+			idx,pieces = layer_features( prep , l )
+			lc,lf,fr = intersect_fractions( grid , features[idx] , epsg , s2nParams.quadtree , pieces )
+			icell.append(lc)
+			ifeat.append(idx[lf])
+			frac.append(fr)
+		return np.hstack(icell),np.hstack(ifeat),np.hstack(frac)
+	
+	## Each feature is clipped only on the cells covering its bounds
+	logger.info( f" * Clip {features.size} features on the grid" )
+	icell,ifeat,frac = [np.zeros(0,dtype=int)],[np.zeros(0,dtype=int)],[np.zeros(0)]
+	for k,(feat,j0,j1,i0,i1) in enumerate(zip(features,*clip_windows( features , grid ))):
+		if j1 <= j0 or i1 <= i0:
+			continue
+		f  = clip_fraction( [feat] , grid , window = (j0,j1,i0,i1) )
+		jw,iw = np.nonzero(f)
+		nz = (j0 + jw) * grid.nx + i0 + iw
+		icell.append(nz)
+		ifeat.append(np.zeros(nz.size,dtype=int) + k)
+		frac.append(f[jw,iw])
+	
+	return np.hstack(icell),np.hstack(ifeat),np.hstack(frac)
+##}}}
+
 @log_start_end(logger)
-def build_mask( grid , ish ):##{{{
+def build_mask( grid , ish , fractions = None , prep = None ):##{{{
 	"""
-	Build the 2d mask according to the method.
+	Build the 2d mask according to the method. With a split by column, ish
+	has one feature per region and the mask is 3d, one layer per feature.
+	The output of cell_fractions can be given to avoid to compute it again.
+	With the method 'point' and a split, overlapping regions are tested in
+	layers (see prepare_features, computed if prep is not given), so a cell is
+	in the layer of each region containing its center.
+	Without split, the fractions of the features are summed per cell, the
+	features being merged before if they overlap (see dissolve_overlaps).
+	The type of the mask is given by mask_dtype.
 	"""
 	
-	method = s2nParams.method
+	method    = s2nParams.method
+	threshold = s2nParams.threshold
+	split     = s2nParams.split_by is not None
 	
 	## Now script
-	mask = np.zeros( (grid.ny * grid.nx) )
+	features = ish.geometry.to_numpy()
+	epsg     = ish.crs.to_epsg()
+	nlayer   = features.size if split else 1
+	dtype    = mask_dtype()
+	mask     = np.zeros( (nlayer,grid.ny * grid.nx) , dtype = dtype if method == "point" else fraction_dtype() )
+	if prep is None:
+		prep = prepare_features( grid , ish , overlap = split )
 	
 	if method == "point":
-		dI = gpd.overlay( grid.pt.to_crs(ish.crs) , ish , how = "intersection" , keep_geom_type = False )
+		x,y    = grid.transform(epsg)
+		layer  = prep["layer"]
+		for l in range(layer.max() + 1 if layer.size > 0 else 0):
+			idx,pieces = layer_features( prep , l )
+			ifeat = points_in_features( x , y , features[idx] , pieces )
+			icell = np.flatnonzero( ifeat > -1 )
+			mask[idx[ifeat[icell]] if split else 0,icell] = 1
+	elif find_engine( grid , epsg ) == "clip" and not split:
+		mask[0,:] = clip_fraction( features , grid ).ravel()
 	else:
-		dI = gpd.overlay( grid.sq.to_crs(ish.crs) , ish , how = "intersection" , keep_geom_type = False )
+		icell,ifeat,frac = cell_fractions( grid , ish , prep ) if fractions is None else fractions
+		if split:
+			mask[ifeat,icell] = frac
+		else:
+			frac = np.minimum( np.bincount( icell , weights = frac , minlength = mask.shape[1] ) , 1 )
+			frac[frac > 1 - 1e-9] = 1
+			mask[0,:] = frac
 	
-	if method == "point":
-		idx = dI["INDEX"].values
-		mask[idx] = 1
-	elif method == "weight":
-		idx = dI["INDEX"].values
-		mask[idx] = dI.to_crs(epsg=3395).area.values / grid.sq.loc[idx,:].to_crs(epsg=3395).area.values
-	elif method == "threshold":
-		idx = dI["INDEX"].values
-		mask[idx] = dI.to_crs(epsg=3395).area.values / grid.sq.loc[idx,:].to_crs(epsg=3395).area.values
-		mask[mask > threshold] = 1
-		mask[~(mask > threshold)] = 0
+	if method == "threshold":
+		mask = ( mask > threshold ).astype(dtype)
 	elif method == "interior":
-		idx = dI["INDEX"].values
-		mask[idx] = dI.to_crs(epsg=3395).area.values / grid.sq.loc[idx,:].to_crs(epsg=3395).area.values
-		mask[mask < 1] = 0
+		mask = ( mask >= 1 ).astype(dtype)
 	elif method == "exterior":
-		idx = dI["INDEX"].values
-		mask[idx] = dI.to_crs(epsg=3395).area.values / grid.sq.loc[idx,:].to_crs(epsg=3395).area.values
-		mask[mask > 0] = 1
+		mask = ( mask > 0 ).astype(dtype)
+	else:
+		mask = mask.astype( dtype , copy = False )
+	
+	mask = mask.reshape( (nlayer,grid.ny,grid.nx) )
 	
-	return mask.reshape( (grid.ny,grid.nx) )
+	return mask if split else mask[0,:,:]
 ##}}}
 
 def find_gm_params():##{{{
@@ -102,113 +226,171 @@ def find_gm_params():##{{{
 	return name,attrs
 ##}}}
 
-@log_start_end(logger)
-def save_netcdf( mask , grid ):##{{{
+def init_netcdf( ncf , grid , regions = None ):##{{{
+	"""
+	Create the layout of the netcdf file ncf (dimensions, variables and
+	attributes) and write the 1d axes, returns the dict of the variables. The
+	mask and the 2d coordinates are written by write_netcdf_tile. If regions
+	is given, the mask is 3d with one layer per region, and regions are the
+	names of the layers.
+	"""
 	
 	## Parameters
 	method  = s2nParams.method
-	ofile   = s2nParams.output
 	oepsg   = s2nParams.oepsg
+	cdtype  = coords_encoding()
 	
-	##
-	with netCDF4.Dataset( ofile , "w" ) as ncf:
-		
-		## Dimensions
-		ncdims = {}
-		ncvars = {}
-		if oepsg == "4326":
-			ncdims["lat"] = ncf.createDimension( "lat" , grid.lat.size )
-			ncdims["lon"] = ncf.createDimension( "lon" , grid.lon.size )
-			
-			ncvars["lat"] = ncf.createVariable( "lat" , "double" , ("lat",) , shuffle = False , compression = "zlib" , complevel = 5 , chunksizes = (grid.lat.size,) )
-			ncvars["lon"] = ncf.createVariable( "lon" , "double" , ("lon",) , shuffle = False , compression = "zlib" , complevel = 5 , chunksizes = (grid.lon.size,) )
-		else:
-			ncdims["y"]   = ncf.createDimension( "y"   , grid.y.size )
-			ncdims["x"]   = ncf.createDimension( "x"   , grid.x.size )
-			ncdims["nv4"] = ncf.createDimension( "nv4" ,           4 )
-			
-			ncvars["y"]    = ncf.createVariable(        "y" , "double" ,          ("y",) , shuffle = False , compression = "zlib" , complevel = 5 , chunksizes = (grid.y.size,) )
-			ncvars["x"]    = ncf.createVariable(        "x" , "double" ,          ("x",) , shuffle = False , compression = "zlib" , complevel = 5 , chunksizes = (grid.x.size,) )
-			ncvars["lat"]  = ncf.createVariable(      "lat" , "double" ,       ("y","x") , shuffle = False , compression = "zlib" , complevel = 5 , chunksizes = (grid.y.size,grid.x.size) )
-			ncvars["lon"]  = ncf.createVariable(      "lon" , "double" ,       ("y","x") , shuffle = False , compression = "zlib" , complevel = 5 , chunksizes = (grid.y.size,grid.x.size) )
-			ncvars["latb"] = ncf.createVariable( "lat_bnds" , "double" , ("y","x","nv4") , shuffle = False , compression = "zlib" , complevel = 5 , chunksizes = (grid.y.size,grid.x.size,4) )
-			ncvars["lonb"] = ncf.createVariable( "lon_bnds" , "double" , ("y","x","nv4") , shuffle = False , compression = "zlib" , complevel = 5 , chunksizes = (grid.y.size,grid.x.size,4) )
-			
-			## Fill and add y / x values / attributes
-			ncvars["y"][:] = grid.y[:]
-			ncvars["x"][:] = grid.x[:]
-			
-			ncvars["y"].setncattr( "standard_name" , "projection_y_coordinate"    )
-			ncvars["y"].setncattr( "long_name"     , "y coordinate of projection" )
-			ncvars["x"].setncattr( "standard_name" , "projection_x_coordinate"    )
-			ncvars["x"].setncattr( "long_name"     , "x coordinate of projection" )
-			try:
-				ncvars["y"].setncattr( "units" , grid.pt.crs.axis_info[1].unit_name )
-			except:
-				pass
-			try:
-				ncvars["x"].setncattr( "units" , grid.pt.crs.axis_info[0].unit_name )
-			except:
-				pass
-			
-			## Fill bounds
-			ncvars["latb"][:] = grid.lat_bnds[:]
-			ncvars["lonb"][:] = grid.lon_bnds[:]
-		
-		## Fill and add lat / lon values / attributes
-		ncvars["lat"][:] = grid.lat[:]
-		ncvars["lon"][:] = grid.lon[:]
+	## Dimensions
+	ncdims = {}
+	ncvars = {}
+	if oepsg == "4326":
+		ncdims["lat"] = ncf.createDimension( "lat" , grid.lat.size )
+		ncdims["lon"] = ncf.createDimension( "lon" , grid.lon.size )
 		
-		ncvars["lat"].setncattr("axis"          , "y"             )
-		ncvars["lat"].setncattr("long_name"     , "Latitude"      )
-		ncvars["lat"].setncattr("standard_name" , "latitude"      )
-		ncvars["lat"].setncattr("units"         , "degrees_north" )
-		
-		ncvars["lon"].setncattr("axis"          , "x"             )
-		ncvars["lon"].setncattr("long_name"     , "Longitude"    )
-		ncvars["lon"].setncattr("standard_name" , "longitude"    )
-		ncvars["lon"].setncattr("units"         , "degrees_east" )
-		
-		
-		## Grid mapping coordinates, if needed
-		if not oepsg == "4326":
-			ncvars["lat"].setncattr( "bounds" , "lat_bnds" )
-			ncvars["lon"].setncattr( "bounds" , "lon_bnds" )
-			
-			gm_name,gm_attrs = find_gm_params()
-			
-			ncvars[gm_name]    = ncf.createVariable( gm_name , "int32" )
-			ncvars[gm_name][:] = 1
-			for key in gm_attrs:
-				ncvars[gm_name].setncattr( key , gm_attrs[key] )
-			ncvars[gm_name].setncattr( "EPSG" , oepsg )
+		ncvars["lat"] = ncf.createVariable( "lat" , "double" , ("lat",) , **nc_encoding( "double" , space = (grid.lat.size,) ) )
+		ncvars["lon"] = ncf.createVariable( "lon" , "double" , ("lon",) , **nc_encoding( "double" , space = (grid.lon.size,) ) )
+	else:
+		ncdims["y"]   = ncf.createDimension( "y"   , grid.y.size )
+		ncdims["x"]   = ncf.createDimension( "x"   , grid.x.size )
+		ncdims["nv4"] = ncf.createDimension( "nv4" ,           4 )
 		
-		## The main variable
-		if not oepsg == "4326":
-			ncvars["area_fraction"] = ncf.createVariable( "area_fraction" , "double" , ("y","x") , shuffle = False , compression = "zlib" , complevel = 5 , chunksizes = (grid.y.size,grid.x.size) )
-			ncvars["area_fraction"].setncattr( "grid_mapping"  , gm_name )
-		else:
-			ncvars["area_fraction"] = ncf.createVariable( "area_fraction" , "double" , ("lat","lon") , shuffle = False , compression = "zlib" , complevel = 5 , chunksizes = (grid.lat.size,grid.lon.size) )
+		ncvars["y"]    = ncf.createVariable(        "y" , "double" ,          ("y",) , **nc_encoding( "double" , space = (grid.ny,) ) )
+		ncvars["x"]    = ncf.createVariable(        "x" , "double" ,          ("x",) , **nc_encoding( "double" , space = (grid.nx,) ) )
+		ncvars["lat"]  = ncf.createVariable(      "lat" , cdtype   ,       ("y","x") , **nc_encoding( cdtype   , space = (grid.ny,grid.nx) ) )
+		ncvars["lon"]  = ncf.createVariable(      "lon" , cdtype   ,       ("y","x") , **nc_encoding( cdtype   , space = (grid.ny,grid.nx) ) )
+		ncvars["latb"] = ncf.createVariable( "lat_bnds" , cdtype   , ("y","x","nv4") , **nc_encoding( cdtype   , space = (grid.ny,grid.nx) , trail = (4,) ) )
+		ncvars["lonb"] = ncf.createVariable( "lon_bnds" , cdtype   , ("y","x","nv4") , **nc_encoding( cdtype   , space = (grid.ny,grid.nx) , trail = (4,) ) )
 		
-		ncvars["area_fraction"][:] = mask[:]
+		## Fill and add y / x values / attributes
+		ncvars["y"][:] = grid.y[:]
+		ncvars["x"][:] = grid.x[:]
 		
-		ncvars["area_fraction"].setncattr( "standard_name" , "area_fraction" )
-		ncvars["area_fraction"].setncattr( "long_name"     , "Area Fraction" )
-		ncvars["area_fraction"].setncattr( "units"         , "1" )
-		ncvars["area_fraction"].setncattr( "coordinates"   , "lat lon" )
+		ncvars["y"].setncattr( "standard_name" , "projection_y_coordinate"    )
+		ncvars["y"].setncattr( "long_name"     , "y coordinate of projection" )
+		ncvars["x"].setncattr( "standard_name" , "projection_x_coordinate"    )
+		ncvars["x"].setncattr( "long_name"     , "x coordinate of projection" )
+		try:
+			ncvars["y"].setncattr( "units" , grid.crs.axis_info[1].unit_name )
+		except:
+			pass
+		try:
+			ncvars["x"].setncattr( "units" , grid.crs.axis_info[0].unit_name )
+		except:
+			pass
+	
+	## Fill lat / lon axes, otherwise written by tiles
+	if oepsg == "4326":
+		ncvars["lat"][:] = grid.lat[:]
+		ncvars["lon"][:] = grid.lon[:]
+	
+	## lat / lon attributes
+	ncvars["lat"].setncattr("axis"          , "y"             )
+	ncvars["lat"].setncattr("long_name"     , "Latitude"      )
+	ncvars["lat"].setncattr("standard_name" , "latitude"      )
+	ncvars["lat"].setncattr("units"         , "degrees_north" )
+	
+	ncvars["lon"].setncattr("axis"          , "x"             )
+	ncvars["lon"].setncattr("long_name"     , "Longitude"    )
+	ncvars["lon"].setncattr("standard_name" , "longitude"    )
+	ncvars["lon"].setncattr("units"         , "degrees_east" )
+	
+	
+	## Grid mapping coordinates, if needed
+	if not oepsg == "4326":
+		ncvars["lat"].setncattr( "bounds" , "lat_bnds" )
+		ncvars["lon"].setncattr( "bounds" , "lon_bnds" )
 		
-		ncvars["area_type"] = ncf.createVariable( "area_type" , "int32" )
-		ncvars["area_type"][:] = 1
-		ncvars["area_type"].setncattr( "standard_name" , "all_area_types" )
-		ncvars["area_type"].setncattr( "long_name"     , "All Area Types" )
+		gm_name,gm_attrs = find_gm_params()
 		
-		## Global attributes
-		ncf.setncattr("title"              , "Mask" )
-		ncf.setncattr("Conventions"        , "CF-1.10" )
-		ncf.setncattr("method"             , method )
-		ncf.setncattr("Shp2ncmask_url"     , src_url )
-		ncf.setncattr("Shp2ncmask_version" , version )
-		ncf.setncattr("creation_date"      , str(dt.datetime.utcnow())[:19] + " (UTC)" )
+		ncvars[gm_name]    = ncf.createVariable( gm_name , "int32" )
+		ncvars[gm_name][:] = 1
+		for key in gm_attrs:
+			ncvars[gm_name].setncattr( key , gm_attrs[key] )
+		ncvars[gm_name].setncattr( "EPSG" , oepsg )
+	
+	## Regions, if a split is used
+	dims   = ("y","x") if not oepsg == "4326" else ("lat","lon")
+	lead   = ()
+	if regions is not None:
+		ncdims["region"] = ncf.createDimension( "region" , len(regions) )
+		ncvars["region"] = ncf.createVariable( "region" , str , ("region",) )
+		ncvars["region"][:] = np.array( regions , dtype = object )
+		ncvars["region"].setncattr( "long_name" , f"Region ({s2nParams.split_by})" )
+		dims   = ("region",) + dims
+		lead   = (len(regions),)
+	
+	## The main variable
+	dtype,attrs = mask_encoding()
+	fill = attrs.pop( "_FillValue" , None )
+	ncvars["area_fraction"] = ncf.createVariable( "area_fraction" , dtype , dims , fill_value = fill , **nc_encoding( dtype , lead = lead , space = (grid.ny,grid.nx) ) )
+	if not oepsg == "4326":
+		ncvars["area_fraction"].setncattr( "grid_mapping"  , gm_name )
+	for key in attrs:
+		ncvars["area_fraction"].setncattr( key , attrs[key] )
+	
+	ncvars["area_fraction"].setncattr( "standard_name" , "area_fraction" )
+	ncvars["area_fraction"].setncattr( "long_name"     , "Area Fraction" )
+	ncvars["area_fraction"].setncattr( "units"         , "1" )
+	ncvars["area_fraction"].setncattr( "coordinates"   , "lat lon" )
+	
+	ncvars["area_type"] = ncf.createVariable( "area_type" , "int32" )
+	ncvars["area_type"][:] = 1
+	ncvars["area_type"].setncattr( "standard_name" , "all_area_types" )
+	ncvars["area_type"].setncattr( "long_name"     , "All Area Types" )
 	
+	## Global attributes
+	ncf.setncattr("title"              , "Mask" )
+	ncf.setncattr("Conventions"        , "CF-1.10" )
+	ncf.setncattr("method"             , method )
+	if regions is not None:
+		ncf.setncattr( "split_by" , s2nParams.split_by )
+	ncf.setncattr("Shp2ncmask_url"     , src_url )
+	ncf.setncattr("Shp2ncmask_version" , version )
+	ncf.setncattr("creation_date"      , str(dt.datetime.utcnow())[:19] + " (UTC)" )
+	
+	return ncvars
+##}}}
+
+def tile_coords( grid , tile ):##{{{
+	"""
+	For a projected grid, the lat / lon and the bounds of the cells tile =
+	(j0,j1,i0,i1) of the grid, computed only for the tile, as a dict with the
+	keys of the variables of init_netcdf. None for a lat / lon grid.
+	"""
+	if s2nParams.oepsg == "4326":
+		return None
+	
+	j0,j1,i0,i1 = tile
+	sub = grid if (j1 - j0,i1 - i0) == (grid.ny,grid.nx) else grid.subgrid(*tile)
+	return { "lat" : sub.lat , "lon" : sub.lon , "latb" : sub.lat_bnds , "lonb" : sub.lon_bnds }
+##}}}
+
+def write_netcdf_tile( ncvars , grid , tile , mask , coords = None ):##{{{
+	"""
+	Write the mask of the cells tile = (j0,j1,i0,i1) of the grid, and for a
+	projected grid the lat / lon and the bounds of these cells. The coordinates
+	are the output of tile_coords, computed here if not given.
+	"""
+	j0,j1,i0,i1 = tile
+	ncvars["area_fraction"][...,j0:j1,i0:i1] = mask
+	
+	if coords is None:
+		coords = tile_coords( grid , tile )
+	if coords is not None:
+		for key in coords:
+			ncvars[key][j0:j1,i0:i1] = coords[key]
+##}}}
+
+@log_start_end(logger)
+def save_netcdf( mask , grid , regions = None , size = 1024 ):##{{{
+	"""
+	Save the mask in a netcdf file (see init_netcdf). The coordinates are
+	computed and written by tiles of size x size cells, so only the mask is
+	in memory for the whole grid.
+	"""
+	with netCDF4.Dataset( s2nParams.output , "w" ) as ncf:
+		ncvars = init_netcdf( ncf , grid , regions )
+		for (j0,j1,i0,i1) in grid.tiles(size):
+			write_netcdf_tile( ncvars , grid , (j0,j1,i0,i1) , mask[...,j0:j1,i0:i1] )
 ##}}}
 
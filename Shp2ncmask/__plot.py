@@ -73,10 +73,7 @@ def build_figure( grid , ish , mask ):
 	norm   = mplc.BoundaryNorm( np.linspace(0,1,11) , 256 )
 	
 	## Coordinates
-	if str(grid.pt.crs.to_epsg()) == fepsg:
-		XY = np.stack( (grid.X,grid.Y) , -1 )
-	else:
-		XY = np.array( [ np.asarray(geo.coords) for geo in grid.pt.to_crs( epsg = fepsg )["geometry"] ] ).reshape(-1,2)
+	XY = np.stack( grid.transform(fepsg) , -1 )
 	
 	## Figure
 	fig = plt.figure()
@@ -0,0 +1,79 @@
+
+## Copyright(c) 2023 Yoann Robin
+## 
+## This file is part of Shp2ncmask.
+## 
+## Shp2ncmask is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+## 
+## Shp2ncmask is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+## 
+## You should have received a copy of the GNU General Public License
+## along with Shp2ncmask.  If not, see <https://www.gnu.org/licenses/>.
+
+##############
+## Packages ##
+##############
+
+import functools
+import logging
+import numpy  as np
+import pyproj
+import shapely
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+###############
+## Functions ##
+###############
+
+@functools.lru_cache( maxsize = None )
+def get_transformer( iepsg , oepsg ):##{{{
+	"""
+	Shp2ncmask.get_transformer
+	==========================
+	
+	Transformer from epsg:iepsg to epsg:oepsg, always in the (x,y) order (so
+	(lon,lat) for epsg:4326). Transformers are cached, so each pair of epsg is
+	built only once.
+	"""
+	return pyproj.Transformer.from_crs( int(iepsg) , int(oepsg) , always_xy = True )
+##}}}
+
+def transform_xy( x , y , iepsg , oepsg ):##{{{
+	"""
+	Shp2ncmask.transform_xy
+	=======================
+	
+	Transform the arrays of coordinates x and y from epsg:iepsg to epsg:oepsg,
+	with one call of the transformer and without building any geometry.
+	"""
+	if str(iepsg) == str(oepsg):
+		return np.asarray(x),np.asarray(y)
+	
+	return get_transformer( str(iepsg) , str(oepsg) ).transform( x , y )
+##}}}
+
+def transform_geoms( geoms , iepsg , oepsg ):##{{{
+	"""
+	Shp2ncmask.transform_geoms
+	==========================
+	
+	Re-project an array of shapely geometries from epsg:iepsg to epsg:oepsg,
+	with one call of the transformer for all vertices.
+	"""
+	geoms = np.asarray(geoms)
+	if str(iepsg) == str(oepsg):
+		return geoms
+	
+	transf = get_transformer( str(iepsg) , str(oepsg) )
+	return shapely.transform( geoms , lambda xy: np.stack( transf.transform( xy[:,0] , xy[:,1] ) , -1 ) )
+##}}}
+
@@ -0,0 +1,127 @@
+
+## Copyright(c) 2023 Yoann Robin
+## 
+## This file is part of Shp2ncmask.
+## 
+## Shp2ncmask is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+## 
+## Shp2ncmask is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+## 
+## You should have received a copy of the GNU General Public License
+## along with Shp2ncmask.  If not, see <https://www.gnu.org/licenses/>.
+
+##############
+## Packages ##
+##############
+
+import logging
+import numpy   as np
+import shapely
+
+from .__proj import transform_xy
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+###############
+## Functions ##
+###############
+
+def block_polygons( grid , blocks , epsg ):##{{{
+	"""
+	Shp2ncmask.block_polygons
+	=========================
+	
+	Polygons of the blocks of cells (j0,j1,i0,i1) of the grid, re-projected in
+	epsg. The outline of a block has the same vertices as the edges of its
+	cells (see Grid.square_template), so it is the union of its cells.
+	"""
+	n = grid.ppe - 1
+	xc,yc = grid.xc,grid.yc
+	
+	rings = []
+	for j0,j1,i0,i1 in blocks:
+		xb = np.linspace( xc[i0] , xc[i1] , (i1 - i0) * n + 1 )
+		yb = np.linspace( yc[j0] , yc[j1] , (j1 - j0) * n + 1 )
+		x  = np.hstack( ( xb[:-1] , np.zeros(yb.size-1) + xc[i1] , xb[::-1][:-1] , np.zeros(yb.size-1) + xc[i0] ) )
+		y  = np.hstack( ( np.zeros(xb.size-1) + yc[j0] , yb[:-1] , np.zeros(xb.size-1) + yc[j1] , yb[::-1][:-1] ) )
+		rings.append( (x,y) )
+	
+	size  = [ x.size for x,_ in rings ]
+	tx,ty = transform_xy( np.hstack([x for x,_ in rings]) , np.hstack([y for _,y in rings]) , grid.epsg , epsg )
+	xy    = np.split( np.stack( (tx,ty) , -1 ) , np.cumsum(size)[:-1] )
+	
+	return np.array( [ shapely.Polygon(c) for c in xy ] , dtype = object )
+##}}}
+
+def quadtree_classify( grid , features , epsg , block = 64 ):##{{{
+	"""
+	Shp2ncmask.quadtree_classify
+	============================
+	
+	Coarse-to-fine classification of the cells, with the same output as
+	classify_cells.
+	
+	The grid is split in blocks of block x block cells. Each block is tested
+	against the prepared features: a block outside all features is 0, a block
+	contained in a feature is 1, and a block crossed by a boundary is split in
+	four, down to single cells. The number of geometric tests grows with the
+	length of the boundary, not with the number of cells.
+	
+	Returns
+	-------
+	inside: array, index of a feature containing the cell, -1 otherwise
+	icell: array of index of the cells of the boundary pairs
+	ifeat: array of index of the features of the boundary pairs
+	"""
+	
+	features = np.asarray(features)
+	tree     = shapely.STRtree(features)
+	shapely.prepare(features)
+	
+	inside = np.zeros( (grid.ny,grid.nx) , dtype = int ) - 1
+	icell  = []
+	ifeat  = []
+	ntest  = 0
+	
+	blocks = grid.tiles(block)
+	while len(blocks) > 0:
+		ntest += len(blocks)
+		polys  = block_polygons( grid , blocks , epsg )
+		ib,ifb = tree.query( polys , predicate = "intersects" )
+		cont   = shapely.contains( features[ifb] , polys[ib] )
+		
+		binside = np.zeros( len(blocks) , dtype = int ) - 1
+		binside[ib[cont]] = ifb[cont]
+		
+		## Boundary pairs of single cells
+		leaf = np.array( [ (j1 - j0) * (i1 - i0) == 1 for j0,j1,i0,i1 in blocks ] )
+		keep = (binside[ib] < 0) & leaf[ib]
+		icell.append( np.array( [ blocks[b][0] * grid.nx + blocks[b][2] for b in ib[keep] ] , dtype = int ) )
+		ifeat.append( ifb[keep] )
+		
+		## Fill inside blocks, and split others
+		nblocks = []
+		for b in np.unique(ib):
+			j0,j1,i0,i1 = blocks[b]
+			if binside[b] > -1:
+				inside[j0:j1,i0:i1] = binside[b]
+			elif not leaf[b]:
+				jm,im = (j0 + j1) // 2 , (i0 + i1) // 2
+				nblocks += [ (ja,jb,ia,ibb) for ja,jb in [(j0,jm),(jm,j1)] for ia,ibb in [(i0,im),(im,i1)] if jb > ja and ibb > ia ]
+		blocks = nblocks
+	
+	icell = np.hstack(icell)
+	ifeat = np.hstack(ifeat)
+	logger.info( f" * Quadtree: {ntest} blocks tested, {(inside > -1).sum()} cells inside, {np.unique(icell).size} on a boundary" )
+	
+	return inside.ravel(),icell,ifeat
+##}}}
+
@@ -0,0 +1,101 @@
+
+## Copyright(c) 2023 Yoann Robin
+## 
+## This file is part of Shp2ncmask.
+## 
+## Shp2ncmask is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+## 
+## Shp2ncmask is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+## 
+## You should have received a copy of the GNU General Public License
+## along with Shp2ncmask.  If not, see <https://www.gnu.org/licenses/>.
+
+##############
+## Packages ##
+##############
+
+import logging
+import numpy   as np
+import shapely
+
+from .__logs import log_start_end
+from .__area import area
+
+
+#############
+## Logging ##
+#############
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+###############
+## Functions ##
+###############
+
+def cell_size( grid , crs ):##{{{
+	"""
+	Mean size (sx,sy) of the cells of the grid in the projection crs, from
+	the extent of the grid in crs (see Grid.extent).
+	"""
+	xmin,ymin,xmax,ymax = grid.extent(crs)
+	return (xmax - xmin) / grid.nx , (ymax - ymin) / grid.ny
+##}}}
+
+@log_start_end(logger)
+def simplify_features( ish , grid , factor ):##{{{
+	"""
+	Shp2ncmask.simplify_features
+	============================
+	
+	Simplify the features of ish with a tolerance equal to factor times the
+	size of the cells of the grid (in the projection of ish), because details
+	smaller than a cell do not change much the area fractions.
+	
+	If the features form a valid coverage (no overlap, shared edges matched),
+	shared edges are simplified once with shapely.coverage_simplify, so no gap
+	or overlap is created between neighbouring features. Otherwise each
+	feature is simplified with shapely.simplify, preserving its topology.
+	
+	The error is reported: the area of the symmetric difference between the
+	original and the simplified features, in units of the area of a cell, is
+	a bound of the sum over all cells of the error of the area fractions. It
+	is an estimate, the area of a cell being the mean over a sample of cells.
+	"""
+	
+	if ish.shape[0] == 0:
+		return ish
+	
+	sx,sy = cell_size( grid , ish.crs )
+	tol   = factor * min(sx,sy)
+	geoms = ish.geometry.to_numpy()
+	
+	if hasattr( shapely , "coverage_simplify" ) and shapely.coverage_is_valid(geoms):
+		logger.info( f" * Coverage simplification, tolerance: {tol}" )
+		simp = shapely.coverage_simplify( geoms , tol )
+	else:
+		logger.info( f" * Simplification preserving topology, tolerance: {tol}" )
+		simp = shapely.simplify( geoms , tol , preserve_topology = True )
+	simp = shapely.make_valid(simp)
+	
+	## Error on the area fractions
+	nv0   = shapely.get_num_coordinates(geoms).sum()
+	nv1   = shapely.get_num_coordinates(simp).sum()
+	delta = area( shapely.symmetric_difference( geoms , simp ) , ish.crs.to_epsg() ).sum()
+	idx   = np.unique( np.linspace( 0 , grid.nx * grid.ny - 1 , 100 ).astype(int) )
+	carea = area( grid.squares(idx) , grid.epsg ).mean()
+	logger.info( f" * Vertices: {nv0} -> {nv1}" )
+	logger.info( f" * Error bound estimate (sum over cells of the error of the fractions): {delta / carea:.6f}" )
+	
+	ish = ish.copy()
+	ish.geometry = simp
+	return ish
+##}}}
+
@@ -0,0 +1,160 @@
+
+## Copyright(c) 2023 Yoann Robin
+## 
+## This file is part of Shp2ncmask.
+## 
+## Shp2ncmask is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+## 
+## Shp2ncmask is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+## 
+## You should have received a copy of the GNU General Public License
+## along with Shp2ncmask.  If not, see <https://www.gnu.org/licenses/>.
+
+##############
+## Packages ##
+##############
+
+import logging
+import numpy as np
+
+from .__S2NParams import s2nParams
+
+
+#############
+## Logging ##
+#############
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+###############
+## Variables ##
+###############
+
+binary_methods = ["point","threshold","interior","exterior"]
+
+
+###############
+## Functions ##
+###############
+
+def fraction_dtype():##{{{
+	"""
+	In-memory type of the area fractions: float64 only if asked as storage
+	type, float32 otherwise.
+	"""
+	return np.dtype("float64") if s2nParams.dtype == "float64" else np.dtype("float32")
+##}}}
+
+def mask_dtype():##{{{
+	"""
+	In-memory type of the mask. Binary methods are stored in one byte per
+	cell (unless a float type is asked), and fractions in fraction_dtype.
+	"""
+	dtype = s2nParams.dtype
+	if s2nParams.method in binary_methods:
+		return np.dtype(dtype) if dtype in ["float32","float64"] else np.dtype("uint8")
+	return fraction_dtype()
+##}}}
+
+def mask_encoding():##{{{
+	"""
+	On-disk type of the mask, and the attributes of the variable. Binary
+	methods are written as they are, by default in uint8. Fractions are by
+	default written in float32; with an integer type they are packed with the
+	CF attribute scale_factor (1/254 or 1/65534), and are unpacked on read by
+	CF-compliant tools. The largest value of the type (the default fill value
+	of netCDF) is kept out of valid_range, as the _FillValue.
+	"""
+	dtype = s2nParams.dtype
+	if dtype == "auto":
+		dtype = "uint8" if s2nParams.method in binary_methods else "float32"
+	dtype = np.dtype(dtype)
+	
+	attrs = {}
+	if dtype.kind == "u":
+		vmax = np.iinfo(dtype).max
+		if s2nParams.method in binary_methods:
+			attrs["valid_range"] = np.array( [0,1] , dtype = dtype )
+		else:
+			attrs["scale_factor"] = np.float32( 1. / (vmax - 1) )
+			attrs["valid_range"]  = np.array( [0,vmax - 1] , dtype = dtype )
+			attrs["_FillValue"]   = dtype.type(vmax)
+	
+	return dtype,attrs
+##}}}
+
+def coords_encoding():##{{{
+	"""
+	On-disk type of the 2d coordinates (lat / lon and their bounds of a
+	projected grid), float32 by default. The 1d axes stay in float64.
+	"""
+	dtype = s2nParams.coords_dtype
+	if dtype == "auto":
+		dtype = "float32"
+	return np.dtype(dtype)
+##}}}
+
+def spatial_chunks( itemsize , target = 2**20 ):##{{{
+	"""
+	Default chunk (cy,cx) along the y / x axes: the largest power of 2 such
+	that a square chunk is lower than target bytes (1MB), with itemsize the
+	number of bytes of one cell.
+	"""
+	side = 2**int(np.floor( np.log2( np.sqrt( target / itemsize ) ) ))
+	side = max( side , 16 )
+	return side,side
+##}}}
+
+def nc_encoding( dtype , lead = () , space = () , trail = () ):##{{{
+	"""
+	Keywords of netCDF4.Dataset.createVariable for the chunks and the
+	compression of a variable of type dtype. The dimensions of the variable are
+	the leading dimensions lead (chunked by 1, e.g. region), the spatial
+	dimensions space ((y,x) or a 1d axis), and the trailing dimensions trail
+	(not chunked, e.g. nv4).
+	
+	2d variables are chunked with '--chunks' if given, otherwise with
+	spatial_chunks, so a partial read touches only the chunks it needs. 1d
+	variables are in chunks of at most 1MB, i.e. in one chunk for the axes.
+	"""
+	
+	itemsize = np.dtype(dtype).itemsize * int(np.prod(trail))
+	if len(space) == 2:
+		chunks = s2nParams.chunks if s2nParams.chunks is not None else spatial_chunks(itemsize)
+		chunks = tuple( min(c,s) for c,s in zip(chunks,space) )
+	else:
+		chunks = tuple( max( min( s , 2**20 // itemsize ) , 1 ) for s in space )
+	chunks = (1,) * len(lead) + chunks + tuple(trail)
+	
+	kwargs = { "chunksizes" : chunks }
+	compression = s2nParams.compression
+	if compression == "none":
+		return kwargs
+	kwargs["compression"] = compression
+	kwargs["complevel"]   = s2nParams.complevel
+	if compression.startswith("blosc"):
+		kwargs["blosc_shuffle"] = 1 if s2nParams.shuffle else 0
+	else:
+		kwargs["shuffle"] = s2nParams.shuffle
+	
+	return kwargs
+##}}}
+
+def pack_mask( mask , dtype , attrs ):##{{{
+	"""
+	Pack the mask in dtype, with the attributes given by mask_encoding, for
+	backends which do not apply scale_factor themselves (zarr).
+	"""
+	if "scale_factor" in attrs:
+		return np.round( np.asarray(mask) / attrs["scale_factor"] ).astype(dtype)
+	return np.asarray(mask).astype( dtype , copy = False )
+##}}}
+
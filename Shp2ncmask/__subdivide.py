@@ -0,0 +1,112 @@
+
+## Copyright(c) 2023 Yoann Robin
+## 
+## This file is part of Shp2ncmask.
+## 
+## Shp2ncmask is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+## 
+## Shp2ncmask is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+## 
+## You should have received a copy of the GNU General Public License
+## along with Shp2ncmask.  If not, see <https://www.gnu.org/licenses/>.
+
+##############
+## Packages ##
+##############
+
+import logging
+import numpy   as np
+import shapely
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+###############
+## Functions ##
+###############
+
+def subdivide( features , max_vertices = 256 , max_depth = 32 ):##{{{
+	"""
+	Shp2ncmask.subdivide
+	====================
+	
+	Split the features in pieces of at most max_vertices vertices, in the style
+	of ST_Subdivide of PostGIS. Multi-polygons are first split in their parts,
+	then a piece with too many vertices is cut in two halves of its bounding
+	box, along its longest side, until it is small enough (or max_depth cuts).
+	
+	The pieces of a feature do not overlap and cover it, so the fractions of a
+	cell covered by the pieces sum to the fraction covered by the feature.
+	
+	Returns
+	-------
+	pieces: array of the polygons
+	owner: array of the index of the feature of each piece, sorted
+	"""
+	
+	features = np.asarray(features)
+	todo,owner = shapely.get_parts( features , return_index = True )
+	pieces,owners = [],[]
+	
+	for _ in range(max_depth):
+		small = shapely.get_num_coordinates(todo) <= max_vertices
+		pieces.append(todo[small])
+		owners.append(owner[small])
+		todo,owner = todo[~small],owner[~small]
+		if todo.size == 0:
+			break
+		
+		## Halves of the bounding boxes
+		xmin,ymin,xmax,ymax = shapely.bounds(todo).T
+		cutx = (xmax - xmin) >= (ymax - ymin)
+		xm   = np.where( cutx , (xmin + xmax) / 2 , xmax )
+		ym   = np.where( cutx , ymax , (ymin + ymax) / 2 )
+		xa   = np.where( cutx , xm , xmin )
+		ya   = np.where( cutx , ymin , ym )
+		half = np.hstack( ( shapely.intersection( todo , shapely.box( xmin , ymin , xm , ym ) ) ,
+		                    shapely.intersection( todo , shapely.box( xa , ya , xmax , ymax ) ) ) )
+		
+		## Keep only polygonal parts
+		todo,idx = shapely.get_parts( half , return_index = True )
+		owner    = np.hstack( (owner,owner) )[idx]
+		keep     = (shapely.get_type_id(todo) == 3) & ~shapely.is_empty(todo)
+		todo,owner = todo[keep],owner[keep]
+	pieces.append(todo)
+	owners.append(owner)
+	
+	pieces = np.hstack(pieces)
+	owner  = np.hstack(owners)
+	order  = np.argsort( owner , kind = "stable" )
+	logger.info( f" * Subdivision: {features.size} features in {pieces.size} pieces of at most {max_vertices} vertices" )
+	
+	return pieces[order],owner[order]
+##}}}
+
+def sum_pieces( icell , ipiece , frac , owner ):##{{{
+	"""
+	Shp2ncmask.sum_pieces
+	=====================
+	
+	Sum back the fractions of the pairs (cell,piece) to the pairs
+	(cell,feature), where owner is the feature of each piece (see subdivide).
+	Sums at a rounding error of 1 are set to 1, and pairs of cells inside a
+	feature come last, as in intersect_fractions.
+	"""
+	
+	ifeat = owner[ipiece]
+	nfeat = int(owner.max()) + 1 if owner.size > 0 else 1
+	upair,pos = np.unique( icell * nfeat + ifeat , return_inverse = True )
+	frac  = np.minimum( np.bincount( pos , weights = frac , minlength = upair.size ) , 1 )
+	frac[frac > 1 - 1e-9] = 1
+	
+	order = np.argsort( frac >= 1 , kind = "stable" )
+	return upair[order] // nfeat,upair[order] % nfeat,frac[order]
+##}}}
+
@@ -0,0 +1,207 @@
+
+## Copyright(c) 2023 Yoann Robin
+## 
+## This file is part of Shp2ncmask.
+## 
+## Shp2ncmask is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+## 
+## Shp2ncmask is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+## 
+## You should have received a copy of the GNU General Public License
+## along with Shp2ncmask.  If not, see <https://www.gnu.org/licenses/>.
+
+##############
+## Packages ##
+##############
+
+import logging
+import itertools
+import concurrent.futures
+import numpy as np
+import netCDF4
+
+from .__logs      import log_start_end
+from .__S2NParams import s2nParams
+from .__grid      import Grid
+from .__mask      import build_mask
+from .__mask      import cell_fractions
+from .__mask      import init_netcdf
+from .__mask      import tile_coords
+from .__mask      import write_netcdf_tile
+from .__zarr      import init_zarr
+from .__zarr      import open_zarr
+from .__zarr      import write_zarr_tile
+from .__weights   import cell_weights
+
+
+#############
+## Logging ##
+#############
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+###############
+## Functions ##
+###############
+
+## State of a worker, set once by the initializer
+_worker = {}
+
+def _init_worker( gparams , params , ish , fish = None , prep = None , fprep = None ):##{{{
+	xparams,yparams,epsg,ppe,cache = gparams
+	s2nParams.__dict__.update(params)
+	_worker["grid"]  = Grid( xparams , yparams , epsg = epsg , ppe = ppe , cache = cache )
+	_worker["ish"]   = ish
+	_worker["fish"]  = ish if fish is None else fish
+	_worker["prep"]  = prep
+	_worker["fprep"] = prep if fish is None else fprep
+##}}}
+
+def _mask_tile( tile ):##{{{
+	grid = _worker["grid"]
+	ish  = _worker["ish"]
+	fish = _worker["fish"]
+	sub  = grid.subgrid(*tile)
+	
+	fractions = None
+	if s2nParams.weights is not None:
+		fractions = cell_fractions( sub , fish , _worker["fprep"] )
+	mask = build_mask( sub , ish , fractions if fish is ish else None , _worker["prep"] )
+	
+	## Weights, with the index of cells in the full grid
+	weights = None
+	if fractions is not None:
+		icell,ifeat,weight = cell_weights( sub , fractions )
+		jt,it   = np.divmod( icell , sub.nx )
+		weights = ( (tile[0] + jt) * grid.nx + tile[2] + it , ifeat , weight )
+	
+	return tile,mask,weights
+##}}}
+
+def _netcdf_tile( tile ):##{{{
+	tile,mask,weights = _mask_tile(tile)
+	return tile,(mask,tile_coords( _worker["grid"] , tile )),weights
+##}}}
+
+def _zarr_tile( tile ):##{{{
+	tile,mask,weights = _mask_tile(tile)
+	write_zarr_tile( open_zarr( s2nParams.output , "r+" ) , _worker["grid"] , tile , mask )
+	return tile,None,weights
+##}}}
+
+def iter_mask_tiles( grid , ish , size , workers = 1 , fun = None , fish = None , prep = None , fprep = None , inflight = 2 ):##{{{
+	"""
+	Shp2ncmask.iter_mask_tiles
+	==========================
+	
+	Iterator over the tiles (j0,j1,i0,i1) of size x size cells of the grid, the
+	mask of each tile, and the output of cell_weights (with index of cells in
+	the full grid) if weights are saved, None otherwise. Each tile is an
+	independent subgrid, so only its cells are in memory. With more than one
+	worker, tiles are computed in a pool of processes; the grid is re-built
+	from its parameters and the shapefile is sent only once per worker. At
+	most inflight x workers tiles are computed or waiting to be used at the
+	same time, and tiles are given in the order they are done, not in the
+	order of the grid.
+	
+	fun is the function applied to each tile in the workers (default is
+	_mask_tile), it must return the tile, the output used by the caller in
+	place of the mask, and the weights. If given, the weights are
+	computed from the features fish instead of ish (the features before the
+	merge of the overlapping features, see dissolve_overlaps). prep and fprep
+	are the outputs of prepare_features for ish and fish, computed once and
+	sent to the workers (otherwise each tile computes them again).
+	"""
+	tiles = grid.tiles(size)
+	fun   = _mask_tile if fun is None else fun
+	logger.info( f" * {len(tiles)} tiles of {size}x{size} cells, {workers} worker(s)" )
+	
+	initargs = ( (grid.xparams,grid.yparams,grid.epsg,grid.ppe,grid.cache) , dict(s2nParams.__dict__) , ish , fish , prep , fprep )
+	if workers == 1:
+		_init_worker(*initargs)
+		for tile in tiles:
+			yield fun(tile)
+		_worker.clear()
+		return
+	
+	## At most inflight x workers tiles are submitted, new tiles are submitted
+	## as tiles are done, and tiles are yielded in the order they are done
+	tiles = iter(tiles)
+	with concurrent.futures.ProcessPoolExecutor( max_workers = workers , initializer = _init_worker , initargs = initargs ) as pool:
+		running = set( pool.submit( fun , tile ) for tile in itertools.islice( tiles , inflight * workers ) )
+		while len(running) > 0:
+			done,running = concurrent.futures.wait( running , return_when = concurrent.futures.FIRST_COMPLETED )
+			for future in done:
+				tile = next( tiles , None )
+				if tile is not None:
+					running.add( pool.submit( fun , tile ) )
+				yield future.result()
+##}}}
+
+def collect_tiles( tiles , write = None ):##{{{
+	"""
+	Consume the output of iter_mask_tiles: write( tile , out ) is called for
+	each tile if given, and the weights of the tiles are concatenated. Returns
+	the output of cell_weights (with index of cells in the full grid) if
+	weights are saved, None otherwise.
+	"""
+	weights = []
+	for tile,out,f in tiles:
+		if write is not None:
+			write( tile , out )
+		if f is not None:
+			weights.append(f)
+	
+	if len(weights) == 0:
+		return None
+	
+	return tuple( np.hstack(f) for f in zip(*weights) )
+##}}}
+
+@log_start_end(logger)
+def save_netcdf_tiled( grid , ish , size , workers = 1 , regions = None , fish = None , prep = None , fprep = None ):##{{{
+	"""
+	Build the mask tile by tile (see iter_mask_tiles), and write each tile in
+	the netcdf file as soon as it is computed: the layout of the file is
+	created first (see init_netcdf), then the mask and the coordinates of
+	each tile, both computed in the workers (see tile_coords), are written.
+	The memory is bounded by the size of the tiles times the number of tiles
+	in flight (see iter_mask_tiles), not by the size of the grid. Returns the
+	output of cell_weights if weights are saved (computed from fish if
+	given), None otherwise.
+	"""
+	
+	def write( tile , out ):
+		m,coords = out
+		write_netcdf_tile( ncvars , grid , tile , m , coords )
+	
+	with netCDF4.Dataset( s2nParams.output , "w" ) as ncf:
+		ncvars  = init_netcdf( ncf , grid , regions )
+		weights = collect_tiles( iter_mask_tiles( grid , ish , size , workers , fun = _netcdf_tile , fish = fish , prep = prep , fprep = fprep ) , write )
+	
+	return weights
+##}}}
+
+@log_start_end(logger)
+def save_zarr_tiled( grid , ish , size , workers = 1 , regions = None , fish = None , prep = None , fprep = None ):##{{{
+	"""
+	Build the mask tile by tile, and write it in a zarr store. The layout of
+	the store is created first (see init_zarr), then each worker writes
+	directly the mask and the coordinates of its tiles. The chunks are aligned
+	with the tiles, so two workers never write the same chunk and no lock is
+	needed. Returns the output of cell_weights if weights are saved
+	(computed from fish if given), None otherwise.
+	"""
+	
+	init_zarr( grid , regions )
+	return collect_tiles( iter_mask_tiles( grid , ish , size , workers , fun = _zarr_tile , fish = fish , prep = prep , fprep = fprep ) )
+##}}}
+
@@ -0,0 +1,141 @@
+
+## Copyright(c) 2023 Yoann Robin
+## 
+## This file is part of Shp2ncmask.
+## 
+## Shp2ncmask is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+## 
+## Shp2ncmask is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+## 
+## You should have received a copy of the GNU General Public License
+## along with Shp2ncmask.  If not, see <https://www.gnu.org/licenses/>.
+
+##############
+## Packages ##
+##############
+
+import os
+import logging
+import datetime  as dt
+import numpy     as np
+import netCDF4
+
+from .__logs      import log_start_end
+from .__release   import version
+from .__release   import src_url
+from .__S2NParams import s2nParams
+from .__area      import area
+from .__storage   import nc_encoding
+
+
+#############
+## Logging ##
+#############
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+###############
+## Functions ##
+###############
+
+def cell_weights( grid , fractions ):##{{{
+	"""
+	Overlap weights (icell,ifeat,weight) of the non-zero pairs of the output
+	of cell_fractions: the area fraction of the cell, or the area (m^2) of
+	the overlap. Only the cells of the pairs are built, from the grid given,
+	so with tiles the areas are computed in each tile from its subgrid.
+	"""
+	icell,ifeat,frac = fractions
+	keep  = frac > 0
+	icell,ifeat,frac = icell[keep],ifeat[keep],frac[keep]
+	
+	if s2nParams.weights_value == "area":
+		ub,pos = np.unique( icell , return_inverse = True )
+		frac   = frac * area( grid.squares(ub) , grid.epsg )[pos]
+	
+	return icell,ifeat,frac
+##}}}
+
+@log_start_end(logger)
+def save_weights( grid , ish , weights , regions = None ):##{{{
+	"""
+	Save the overlap weights between cells and features (output of
+	cell_weights) as a sparse matrix in coordinate format in a netcdf file:
+	the row is the index of the cell in the flattened grid (j * nx + i), the
+	column the index of the feature, and the value the area fraction of the
+	cell or the area (m^2) of the overlap.
+	
+	A netcdf dimension of size 0 is unlimited, so if there is no feature or
+	no non-zero weight, the file is not written (and a previous file is
+	removed). Returns True if the file is written.
+	"""
+	
+	## Parameters
+	ofile = s2nParams.weights
+	value = s2nParams.weights_value
+	
+	icell,ifeat,weight = weights
+	order = np.lexsort( (ifeat,icell) )
+	icell,ifeat,weight = icell[order],ifeat[order],weight[order]
+	logger.info( f" * {weight.size} non-zero weights" )
+	
+	if weight.size == 0 or ish.shape[0] == 0:
+		logger.warning( f"No non-zero weight, the weights file '{ofile}' is not written" )
+		if os.path.isfile(ofile):
+			os.remove(ofile)
+		return False
+	
+	with netCDF4.Dataset( ofile , "w" ) as ncf:
+		
+		ncf.createDimension( "pair"    , weight.size )
+		ncf.createDimension( "feature" , ish.shape[0] )
+		
+		ncvars = {}
+		ncvars["cell"]    = ncf.createVariable( "cell"    , "int64"  , ("pair",) , **nc_encoding( "int64" , space = (weight.size,) ) )
+		ncvars["feature"] = ncf.createVariable( "feature" , "int32"  , ("pair",) , **nc_encoding( "int32" , space = (weight.size,) ) )
+		ncvars["weight"]  = ncf.createVariable( "weight"  , "double" , ("pair",) , **nc_encoding( "double" , space = (weight.size,) ) )
+		ncvars["cell"][:]    = icell
+		ncvars["feature"][:] = ifeat
+		ncvars["weight"][:]  = weight
+		
+		ncvars["cell"].setncattr( "long_name" , "Index of the cell in the flattened grid (j * nx + i)" )
+		ncvars["feature"].setncattr( "long_name" , "Index of the feature" )
+		if value == "area":
+			ncvars["weight"].setncattr( "long_name" , "Area of the overlap of the cell and the feature" )
+			ncvars["weight"].setncattr( "units"     , "m2" )
+		else:
+			ncvars["weight"].setncattr( "long_name" , "Fraction of the cell covered by the feature" )
+			ncvars["weight"].setncattr( "units"     , "1" )
+		
+		## Features
+		ncvars["feature_id"] = ncf.createVariable( "feature_id" , "int64" , ("feature",) )
+		ncvars["feature_id"][:] = np.arange(ish.shape[0]) if regions is not None else np.asarray(ish.index,dtype=np.int64)
+		ncvars["feature_id"].setncattr( "long_name" , "Index of the feature in the shapefile" )
+		if regions is not None:
+			ncvars["feature_id"].setncattr( "long_name" , "Index of the region" )
+			ncvars["region"] = ncf.createVariable( "region" , str , ("feature",) )
+			ncvars["region"][:] = np.array( regions , dtype = object )
+			ncvars["region"].setncattr( "long_name" , f"Region ({s2nParams.split_by})" )
+		
+		## Global attributes
+		ncf.setncattr("title"              , "Overlap weights" )
+		ncf.setncattr("value"              , value )
+		ncf.setncattr("ny"                 , grid.ny )
+		ncf.setncattr("nx"                 , grid.nx )
+		ncf.setncattr("grid"               , ",".join([str(p) for p in list(grid.xparams) + list(grid.yparams)]) )
+		ncf.setncattr("EPSG"               , grid.epsg )
+		ncf.setncattr("Shp2ncmask_url"     , src_url )
+		ncf.setncattr("Shp2ncmask_version" , version )
+		ncf.setncattr("creation_date"      , str(dt.datetime.utcnow())[:19] + " (UTC)" )
+	
+	return True
+##}}}
+
@@ -0,0 +1,227 @@
+
+## Copyright(c) 2023 Yoann Robin
+## 
+## This file is part of Shp2ncmask.
+## 
+## Shp2ncmask is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+## 
+## Shp2ncmask is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+## 
+## You should have received a copy of the GNU General Public License
+## along with Shp2ncmask.  If not, see <https://www.gnu.org/licenses/>.
+
+##############
+## Packages ##
+##############
+
+import logging
+import datetime  as dt
+import numpy     as np
+
+try:
+	import zarr
+	import numcodecs
+except:
+	zarr      = None
+	numcodecs = None
+
+from .__logs      import log_start_end
+from .__release   import version
+from .__release   import src_url
+from .__S2NParams import s2nParams
+from .__S2NParams import blosc_cnames
+from .__storage   import coords_encoding
+from .__storage   import mask_encoding
+from .__storage   import nc_encoding
+from .__storage   import pack_mask
+from .__mask      import find_gm_params
+
+
+#############
+## Logging ##
+#############
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+for mod in ["zarr","numcodecs","asyncio"]:
+	logging.getLogger(mod).setLevel(logging.ERROR)
+
+
+###############
+## Functions ##
+###############
+
+def open_zarr( ofile , mode ):##{{{
+	"""
+	Open the zarr store ofile (version 2 of the format, read by xarray).
+	"""
+	if zarr is None:
+		raise Exception( "Error: the package 'zarr' is required for the zarr output" )
+	return zarr.open_group( store = ofile , mode = mode , zarr_format = 2 )
+##}}}
+
+def zarr_compressor():##{{{
+	"""
+	numcodecs compressor corresponding to '--compression' and '--complevel'.
+	"""
+	compression = s2nParams.compression
+	level       = s2nParams.complevel
+	shuffle     = 1 if s2nParams.shuffle else 0
+	
+	if compression == "none":
+		return None
+	if compression == "zlib":
+		return numcodecs.Zlib( level = level )
+	if compression == "zstd":
+		return numcodecs.Zstd( level = level )
+	if compression == "bzip2":
+		return numcodecs.BZ2( level = max(level,1) )
+	if compression.startswith("blosc"):
+		return numcodecs.Blosc( cname = blosc_cnames[compression] , clevel = level , shuffle = shuffle )
+	raise Exception( f"Error: the compression '{compression}' is not available for the zarr output" )
+##}}}
+
+def zarr_chunks( dtype , lead = () , space = () , trail = () ):##{{{
+	"""
+	Chunks of a zarr array, as for netcdf (see nc_encoding). With tiles and
+	without '--chunks', the chunks along y / x are the tiles, so that each
+	worker writes its own chunks.
+	"""
+	chunks = nc_encoding( dtype , lead , space , trail )["chunksizes"]
+	size   = s2nParams.tile_size
+	if len(space) == 2 and size is not None and s2nParams.chunks is None:
+		chunks = (1,) * len(lead) + ( min(size,space[0]) , min(size,space[1]) ) + tuple(trail)
+	return chunks
+##}}}
+
+def _create_array( group , name , dtype , dims , attrs , lead = () , space = () , trail = () , fill_value = None ):##{{{
+	shape  = tuple(lead) + tuple(space) + tuple(trail)
+	kwargs = { "compressors" : zarr_compressor() , "fill_value" : fill_value }
+	if len(shape) > 0:
+		kwargs["chunks"] = zarr_chunks( dtype , lead , space , trail )
+	arr = group.create_array( name = name , shape = shape , dtype = dtype , **kwargs )
+	arr.attrs.update( { "_ARRAY_DIMENSIONS" : list(dims) , **attrs } )
+	return arr
+##}}}
+
+def init_zarr( grid , regions = None ):##{{{
+	"""
+	Create the layout of the zarr store s2nParams.output, with the same
+	variables and attributes as the netcdf file (see init_netcdf), and write
+	the 1d axes. Dimensions are given by the attribute '_ARRAY_DIMENSIONS'.
+	The mask and the 2d coordinates are written by write_zarr_tile.
+	"""
+	
+	## Parameters
+	method = s2nParams.method
+	oepsg  = s2nParams.oepsg
+	cdtype = coords_encoding()
+	ny,nx  = grid.ny,grid.nx
+	group  = open_zarr( s2nParams.output , "w" )
+	
+	lat_attrs = { "axis" : "y" , "long_name" : "Latitude"  , "standard_name" : "latitude"  , "units" : "degrees_north" }
+	lon_attrs = { "axis" : "x" , "long_name" : "Longitude" , "standard_name" : "longitude" , "units" : "degrees_east"  }
+	
+	## Coordinates
+	if oepsg == "4326":
+		dims = ("lat","lon")
+		_create_array( group , "lat" , "float64" , ("lat",) , lat_attrs , space = (ny,) )[:] = grid.lat
+		_create_array( group , "lon" , "float64" , ("lon",) , lon_attrs , space = (nx,) )[:] = grid.lon
+	else:
+		dims = ("y","x")
+		y_attrs = { "standard_name" : "projection_y_coordinate" , "long_name" : "y coordinate of projection" }
+		x_attrs = { "standard_name" : "projection_x_coordinate" , "long_name" : "x coordinate of projection" }
+		try:
+			y_attrs["units"] = grid.crs.axis_info[1].unit_name
+			x_attrs["units"] = grid.crs.axis_info[0].unit_name
+		except:
+			pass
+		_create_array( group , "y" , "float64" , ("y",) , y_attrs , space = (ny,) )[:] = grid.y
+		_create_array( group , "x" , "float64" , ("x",) , x_attrs , space = (nx,) )[:] = grid.x
+		_create_array( group ,      "lat" , cdtype ,       ("y","x") , { **lat_attrs , "bounds" : "lat_bnds" } , space = (ny,nx) )
+		_create_array( group ,      "lon" , cdtype ,       ("y","x") , { **lon_attrs , "bounds" : "lon_bnds" } , space = (ny,nx) )
+		_create_array( group , "lat_bnds" , cdtype , ("y","x","nv4") , {} , space = (ny,nx) , trail = (4,) )
+		_create_array( group , "lon_bnds" , cdtype , ("y","x","nv4") , {} , space = (ny,nx) , trail = (4,) )
+		
+		## Grid mapping
+		gm_name,gm_attrs = find_gm_params()
+		_create_array( group , gm_name , "int32" , () , { **gm_attrs , "EPSG" : oepsg } )[...] = 1
+	
+	## Regions, if a split is used
+	lead = ()
+	if regions is not None:
+		regions = np.array( regions , dtype = str )
+		_create_array( group , "region" , regions.dtype , ("region",) , { "long_name" : f"Region ({s2nParams.split_by})" } , space = (regions.size,) )[:] = regions
+		dims = ("region",) + dims
+		lead = (regions.size,)
+	
+	## The main variable
+	dtype,attrs = mask_encoding()
+	fill  = attrs.pop( "_FillValue" , None )
+	attrs = { key : attrs[key].tolist() for key in attrs }
+	attrs.update( { "standard_name" : "area_fraction" , "long_name" : "Area Fraction" , "units" : "1" , "coordinates" : "lat lon" } )
+	if not oepsg == "4326":
+		attrs["grid_mapping"] = gm_name
+	_create_array( group , "area_fraction" , dtype , dims , attrs , lead = lead , space = (ny,nx) , fill_value = fill )
+	
+	_create_array( group , "area_type" , "int32" , () , { "standard_name" : "all_area_types" , "long_name" : "All Area Types" } )[...] = 1
+	
+	## Global attributes
+	gattrs = { "title" : "Mask" , "Conventions" : "CF-1.10" , "method" : method }
+	if regions is not None:
+		gattrs["split_by"] = s2nParams.split_by
+	gattrs.update( { "Shp2ncmask_url" : src_url , "Shp2ncmask_version" : version , "creation_date" : str(dt.datetime.utcnow())[:19] + " (UTC)" } )
+	group.attrs.update(gattrs)
+	
+	## The layout does not change anymore
+	zarr.consolidate_metadata( s2nParams.output , zarr_format = 2 )
+	
+	return group
+##}}}
+
+def write_zarr_tile( group , grid , tile , mask ):##{{{
+	"""
+	Write the mask of the cells tile = (j0,j1,i0,i1) of the grid, and for a
+	projected grid the lat / lon and the bounds of these cells (see
+	write_netcdf_tile). The mask is packed with pack_mask.
+	"""
+	j0,j1,i0,i1 = tile
+	dtype,attrs = mask_encoding()
+	group["area_fraction"][...,j0:j1,i0:i1] = pack_mask( mask , dtype , attrs )
+	
+	if not s2nParams.oepsg == "4326":
+		sub = grid if (j1 - j0,i1 - i0) == (grid.ny,grid.nx) else grid.subgrid(*tile)
+		group["lat"][j0:j1,i0:i1]      = sub.lat
+		group["lon"][j0:j1,i0:i1]      = sub.lon
+		group["lat_bnds"][j0:j1,i0:i1] = sub.lat_bnds
+		group["lon_bnds"][j0:j1,i0:i1] = sub.lon_bnds
+##}}}
+
+@log_start_end(logger)
+def save_zarr( mask , grid , regions = None , size = 1024 ):##{{{
+	"""
+	Save the mask in a zarr store (see init_zarr). The coordinates are computed
+	and written by tiles of size x size cells.
+	"""
+	group = init_zarr( grid , regions )
+	for (j0,j1,i0,i1) in grid.tiles(size):
+		write_zarr_tile( group , grid , (j0,j1,i0,i1) , mask[...,j0:j1,i0:i1] )
+##}}}
+
+def load_zarr_mask( ofile ):##{{{
+	"""
+	Read and unpack the mask of the zarr store ofile.
+	"""
+	arr  = open_zarr( ofile , "r" )["area_fraction"]
+	mask = np.asarray( arr[...] )
+	if "scale_factor" in arr.attrs:
+		mask = mask * arr.attrs["scale_factor"]
+	return mask
+##}}}
+
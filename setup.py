@@ -32,9 +32,10 @@ scripts          = ["scripts/shp2ncmask"]
 requires         = [ "numpy (>=1.17)",
 					 "netCDF4 (>=1.5)",
 					 "pyproj (>=2.5)",
-					 "shapely (>=1.7)",
-					 "geopandas (>=0.7)",
+					 "shapely (>=2.0)",
+					 "geopandas (>=1.0)",
 					 "matplotlib (>=3.1)"]
+extras_require   = { "zarr" : ["zarr>=3","numcodecs"] }
 keywords         = ["shapefile","netcdf","mask"]
 platforms        = ["linux","macosx"]
 classifiers      = ["Development Status :: 4 - Beta",
@@ -62,6 +63,7 @@ setup(  name             = name,
 		packages         = packages,
 		package_dir      = package_dir,
 		requires         = requires,
+		extras_require   = extras_require,
 		scripts          = scripts,
 		license          = license,
 		keywords         = keywords,